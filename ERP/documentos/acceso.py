@@ -0,0 +1,60 @@
+from django.core.cache import cache
+
+from .models import Bodega
+
+
+##########################################################################
+# Bodegas por usuario
+##########################################################################
+VERSION = 'documentos:acceso:version'
+TIEMPO = 60*60
+
+def _clave(usuario):
+    ''' La versión forma parte de la llave, al incrementarla se descarta todo lo guardado '''
+    return f'documentos:acceso:{cache.get_or_set(VERSION, 1, None)}:{usuario.pk}'
+
+def accesos(usuario):
+    '''
+        Llaves de las bodegas en las que el usuario es personal y de todas a
+        las que tiene acceso (personal o encargado). Se consultan una vez y
+        quedan en caché hasta que cambie alguna bodega.
+    '''
+    clave = _clave(usuario)
+    valor = cache.get(clave)
+    if valor is None:
+        personal = frozenset(Bodega.objects.filter(personal=usuario).values_list('id', flat=True))
+        encargado = frozenset(Bodega.objects.filter(encargado=usuario).values_list('id', flat=True))
+        valor = (personal, personal | encargado)
+        cache.set(clave, valor, TIEMPO)
+    return valor
+
+def bodegas_personal(usuario):
+    return accesos(usuario)[0]
+
+def bodegas_usuario(usuario):
+    return accesos(usuario)[1]
+
+def invalida_accesos():
+    try:
+        cache.incr(VERSION)
+    except ValueError:
+        cache.set(VERSION, 1, None)
+
+
+##########################################################################
+# Vistas
+##########################################################################
+class AccesoBodega_Mixin:
+    '''
+        Limita el queryset a las bodegas del usuario (salvo superusuario) con
+        un filtro "IN" sobre la llave de la bodega, sin unir personal ni
+        encargado y sin DISTINCT. "campo_bodega" es la ruta hasta la llave de
+        la bodega desde el modelo de la vista.
+    '''
+    campo_bodega = 'id'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.user.is_superuser:
+            return queryset
+        return queryset.filter(**{f'{self.campo_bodega}__in': bodegas_usuario(self.request.user)})
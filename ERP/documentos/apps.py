@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DocumentosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'documentos'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,688 @@
+import csv
+import django
+import hashlib
+import io
+import openpyxl
+import os
+import tempfile
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+from datetime import datetime, date
+from decimal import Decimal, InvalidOperation
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+from django.core.files import File
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from .models import Cliente, Moneda, Producto, Oficina, Credito, Tomo, CargaCredito
+
+
+COLUMNAS = ('Cod_Cliente', 'Cliente', 'Cod_ofi', 'Oficina', 'Moneda', 'Producto',
+    'Credito', 'Fecha_Ini', 'Monto')
+TAMANO_LOTE = 5000  # créditos por cada escritura a la base de datos
+MAX_ERRORES = 500   # errores detallados que se conservan en el reporte
+CAMPOS_REPORTE = ('leidos', 'insertados', 'actualizados', 'sin_cambio', 'omitidos')
+
+
+##########################################################################
+# Lectura
+##########################################################################
+def abre_libro(archivo):
+    '''
+        Abre el libro en modo solo lectura (streaming) y devuelve un iterador
+        con los valores de cada fila de la primera hoja. En ese modo el libro
+        mantiene el archivo abierto, se cierra al terminar de recorrerlo.
+    '''
+    libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        yield from libro[libro.sheetnames[0]].iter_rows(values_only=True)
+    finally:
+        libro.close()
+
+def abre_csv(archivo):
+    '''
+        Devuelve un iterador con los valores de cada fila del archivo CSV,
+        el separador (coma o punto y coma) se toma del encabezado
+    '''
+    texto = io.TextIOWrapper(archivo, encoding='utf-8-sig', newline='')
+    encabezado = texto.readline()
+    separador = _separador_csv(encabezado)
+    yield from csv.reader([encabezado], delimiter=separador)
+    yield from csv.reader(texto, delimiter=separador)
+
+def _separador_csv(encabezado):
+    return ';' if encabezado.count(';') > encabezado.count(',') else ','
+
+def es_csv(nombre):
+    return nombre.lower().endswith('.csv')
+
+def abre_archivo(archivo, nombre):
+    return abre_csv(archivo) if es_csv(nombre) else abre_libro(archivo)
+
+def nuevo_reporte():
+    reporte = {campo: 0 for campo in CAMPOS_REPORTE}
+    reporte.update({'cant_errores': 0, 'errores': []})
+    return reporte
+
+def _acumula(reporte, conteo, cantidad):
+    ''' Suma al reporte el resultado de guardar un lote de "cantidad" créditos '''
+    for campo, valor in conteo.items():
+        reporte[campo] += valor
+    reporte['omitidos'] += cantidad - sum(conteo.values())
+
+def agrega_error(reporte, fila, mensaje):
+    reporte['cant_errores'] += 1
+    if len(reporte['errores']) < MAX_ERRORES:
+        reporte['errores'].append({'fila': fila, 'mensaje': mensaje})
+
+def nuevo_lote():
+    return {'clientes': {}, 'oficinas': {}, 'monedas': {}, 'productos': {}, 'creditos': {}}
+
+def datos_excel(filas, reporte, tamano_lote=TAMANO_LOTE):
+    '''
+        Recorre las filas (tuplas de valores, la primera es el encabezado) y
+        devuelve lotes con los datos sin repetir (un solo lote si tamano_lote
+        es None). Las filas con errores se agregan al reporte y no se incluyen
+        en el lote.
+    '''
+    encabezado = next(filas, None) or ()
+    orden = {str(valor).strip(): i for i, valor in enumerate(encabezado) if valor is not None}
+    faltantes = [columna for columna in COLUMNAS if columna not in orden]
+    if faltantes:
+        agrega_error(reporte, 1, _('Columnas faltantes: ')+', '.join(faltantes))
+        return
+
+    vistos = set()
+    lote = nuevo_lote()
+    for num_fila, fila in enumerate(filas, start=2):
+        if not any(valor is not None for valor in fila):
+            continue    # filas vacías al final de la hoja
+        reporte['leidos'] += 1
+        try:
+            dato = _valida_fila(fila, orden)
+        except ValueError as error:
+            agrega_error(reporte, num_fila, str(error))
+            reporte['omitidos'] += 1
+            continue
+
+        if dato['credito'] in vistos:
+            reporte['omitidos'] += 1
+            continue
+        vistos.add(dato['credito'])
+
+        lote['clientes'].setdefault(dato['mis'], dato['cliente'])
+        lote['oficinas'].setdefault(dato['cod_ofi'], dato['oficina'])
+        lote['monedas'].setdefault(dato['moneda'], None)
+        lote['productos'].setdefault(dato['producto'], None)
+        credito = [dato['credito'], dato['fecha'], dato['monto'], dato['mis'], 
+            dato['cod_ofi'], dato['moneda'], dato['producto']]
+        lote['creditos'][dato['credito']] = credito + [huella_credito(*credito)]
+
+        if tamano_lote and len(lote['creditos']) >= tamano_lote:
+            yield lote
+            lote = nuevo_lote()
+
+    if lote['creditos']:
+        yield lote
+
+def _valida_fila(fila, orden):
+    ''' Convierte los valores de la fila, ValueError con el detalle del problema '''
+    valores = {}
+    for columna in COLUMNAS:
+        valor = fila[orden[columna]] if orden[columna] < len(fila) else None
+        if isinstance(valor, str):
+            valor = valor.strip()
+        if valor is None or valor == '':
+            raise ValueError(_('Columna sin valor: ')+columna)
+        valores[columna] = valor
+
+    try:
+        mis = int(valores['Cod_Cliente'])
+        cod_ofi = int(valores['Cod_ofi'])
+    except (TypeError, ValueError):
+        raise ValueError(_('Código de cliente u oficina no numérico'))
+
+    try:
+        monto = Decimal(str(valores['Monto'])).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(_('Monto inválido: ')+str(valores['Monto']))
+
+    fecha = valores['Fecha_Ini']
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    elif not isinstance(fecha, date):
+        try:
+            fecha = datetime.strptime(str(fecha), "%d/%m/%Y").date()
+        except ValueError:
+            raise ValueError(_('Fecha inválida: ')+str(fecha))
+
+    return {
+        'mis': mis, 'cliente': str(valores['Cliente']),
+        'cod_ofi': cod_ofi, 'oficina': str(valores['Oficina']),
+        'moneda': str(valores['Moneda']), 'producto': str(valores['Producto']),
+        'credito': str(valores['Credito']), 'fecha': fecha, 'monto': monto,
+    }
+
+def huella_credito(numero, fecha, monto, mis, cod_ofi, moneda, producto):
+    '''
+        Huella de los datos del crédito en el archivo, permite saber si cambió
+        respecto a la última carga. Debe coincidir con la calculada en
+        _merge_creditos para los CSV cargados en MySQL.
+    '''
+    texto = '|'.join([numero, fecha.isoformat(), str(monto), str(mis), str(cod_ofi), 
+        moneda, producto])
+    return hashlib.md5(texto.encode('utf-8')).hexdigest()
+
+def carga_creditos(filas, actualizar=False, usuario=None, tamano_lote=TAMANO_LOTE, progreso=None,
+        crear_tomo=False):
+    '''
+        Carga por lotes los créditos de las filas indicadas, cada lote se
+        guarda en su propia transacción. Devuelve el reporte de la carga.
+        actualizar: modifica los datos de los créditos existentes
+        progreso: función que recibe el reporte luego de cada lote
+        crear_tomo: crea el tomo 1 de los créditos nuevos
+    '''
+    _valida_tomo(crear_tomo, usuario)
+    reporte = nuevo_reporte()
+    for lote in datos_excel(filas, reporte, tamano_lote):
+        with transaction.atomic():
+            _acumula(reporte, _insert_datos(lote, actualizar, usuario, crear_tomo), 
+                len(lote['creditos']))
+        if progreso:
+            progreso(reporte)
+    return reporte
+
+
+##########################################################################
+# Varios archivos
+##########################################################################
+EXTENSIONES = ('.xlsx', '.csv')
+
+def es_zip(nombre):
+    return nombre.lower().endswith('.zip')
+
+def empaqueta(archivos):
+    '''
+        Une los archivos subidos en un zip (sin compresión) para registrarlos
+        como una sola carga
+    '''
+    contenido = tempfile.TemporaryFile()
+    with zipfile.ZipFile(contenido, 'w', zipfile.ZIP_STORED) as empaque:
+        for i, archivo in enumerate(archivos, start=1):
+            with empaque.open(f'{i:02d}_{os.path.basename(archivo.name)}', 'w') as destino:
+                for parte in archivo.chunks():
+                    destino.write(parte)
+    contenido.seek(0)
+    return File(contenido, name='carga.zip')
+
+def extrae_zip(ruta, directorio):
+    ''' Extrae los libros y CSV del zip y devuelve sus rutas '''
+    rutas = []
+    with zipfile.ZipFile(ruta) as empaque:
+        for i, miembro in enumerate(empaque.infolist()):
+            nombre = os.path.basename(miembro.filename)
+            if miembro.is_dir() or not nombre.lower().endswith(EXTENSIONES):
+                continue
+            destino = os.path.join(directorio, f'{i:04d}', nombre)
+            os.makedirs(os.path.dirname(destino))
+            with empaque.open(miembro) as origen, open(destino, 'wb') as archivo:
+                while parte := origen.read(1024*1024):
+                    archivo.write(parte)
+            rutas.append(destino)
+    return rutas
+
+def _parsea_archivo(ruta):
+    ''' Lee el archivo completo (se ejecuta en un proceso aparte, no usa la base de datos) '''
+    reporte = nuevo_reporte()
+    with open(ruta, 'rb') as archivo:
+        datos = next(datos_excel(abre_archivo(archivo, ruta), reporte, None), nuevo_lote())
+    return datos, reporte
+
+def carga_varios(rutas, actualizar=False, usuario=None, procesos=None, crear_tomo=False,
+        progreso=None):
+    '''
+        Lee los archivos en paralelo (un proceso por archivo, hasta "procesos"),
+        une los datos sin repetir créditos y los guarda en una sola transacción
+        progreso: función que recibe el reporte luego de unir cada archivo y
+        de guardar cada lote
+    '''
+    _valida_tomo(crear_tomo, usuario)
+    reporte = nuevo_reporte()
+    datos = nuevo_lote()
+    with ProcessPoolExecutor(max_workers=procesos, initializer=django.setup) as pool:
+        for ruta, (parcial, reporte_parcial) in zip(rutas, pool.map(_parsea_archivo, rutas)):
+            nombre = os.path.basename(ruta)
+            reporte['leidos'] += reporte_parcial['leidos']
+            reporte['omitidos'] += reporte_parcial['omitidos']
+            reporte['cant_errores'] += reporte_parcial['cant_errores']
+            errores = reporte_parcial['errores'][:MAX_ERRORES-len(reporte['errores'])]
+            reporte['errores'] += [{'fila': f"{nombre}: {error['fila']}", 'mensaje': error['mensaje']}
+                for error in errores]
+
+            for catalogo in ('clientes', 'oficinas', 'monedas', 'productos'):
+                for llave, valor in parcial[catalogo].items():
+                    datos[catalogo].setdefault(llave, valor)
+            for numero, credito in parcial['creditos'].items():
+                if numero in datos['creditos']:
+                    reporte['omitidos'] += 1
+                else:
+                    datos['creditos'][numero] = credito
+            if progreso:
+                progreso(reporte)
+
+    with transaction.atomic():
+        for lote in divide_lote(datos):
+            _acumula(reporte, _insert_datos(lote, actualizar, usuario, crear_tomo), 
+                len(lote['creditos']))
+            if progreso:
+                progreso(reporte)
+    return reporte
+
+def divide_lote(datos, tamano_lote=TAMANO_LOTE):
+    ''' Separa los datos en lotes de créditos, cada uno con sus catálogos '''
+    creditos = list(datos['creditos'].values())
+    for inicio in range(0, len(creditos), tamano_lote):
+        lote = nuevo_lote()
+        for credito in creditos[inicio:inicio+tamano_lote]:
+            numero, fecha, monto, mis, cod_ofi, moneda, producto, huella = credito
+            lote['clientes'][mis] = datos['clientes'][mis]
+            lote['oficinas'][cod_ofi] = datos['oficinas'][cod_ofi]
+            lote['monedas'][moneda] = None
+            lote['productos'][producto] = None
+            lote['creditos'][numero] = credito
+        yield lote
+
+
+##########################################################################
+# Procesamiento en segundo plano
+##########################################################################
+def siguiente_carga():
+    '''
+        Toma la carga pendiente más antigua. El cambio de estado se hace con
+        un update condicionado para que dos procesos no tomen la misma carga.
+    '''
+    pendientes = CargaCredito.objects.filter(estado=CargaCredito.PENDIENTE)\
+        .order_by('fecha_creacion').values_list('id', flat=True)
+    for pk in pendientes[:10]:
+        tomada = CargaCredito.objects.filter(pk=pk, estado=CargaCredito.PENDIENTE)\
+            .update(estado=CargaCredito.PROCESANDO, fecha_inicio=timezone.now())
+        if tomada:
+            return CargaCredito.objects.get(pk=pk)
+    return None
+
+def procesa_carga(carga):
+    ''' Ejecuta la carga indicada actualizando su avance en la tabla '''
+    cargas = CargaCredito.objects.filter(pk=carga.pk)
+    progreso, cierra_avance = avance_carga(carga)
+
+    try:
+        if es_zip(carga.archivo.name):
+            with tempfile.TemporaryDirectory() as directorio:
+                rutas = extrae_zip(carga.archivo.path, directorio)
+                reporte = carga_varios(rutas, carga.actualizar, carga.usuario, 
+                    crear_tomo=carga.crear_tomo, progreso=progreso)
+        elif es_csv(carga.archivo.name) and connection.vendor == 'mysql':
+            reporte = carga_csv_mysql(carga.archivo.path, carga.actualizar, carga.usuario, 
+                carga.crear_tomo, progreso)
+        else:
+            with carga.archivo.open('rb') as archivo:
+                reporte = carga_creditos(abre_archivo(archivo, carga.archivo.name), 
+                    carga.actualizar, carga.usuario, progreso=progreso, crear_tomo=carga.crear_tomo)
+    except Exception as error:
+        cargas.update(estado=CargaCredito.ERROR, mensaje=str(error), fecha_fin=timezone.now())
+        raise
+    finally:
+        cierra_avance()
+    cargas.update(estado=CargaCredito.TERMINADO, fecha_fin=timezone.now(), reporte=reporte,
+        **{campo: reporte[campo] for campo in CAMPOS_REPORTE})
+    return reporte
+
+
+def avance_carga(carga):
+    '''
+        Devuelve la función que guarda el avance del reporte en la carga y la
+        que cierra su conexión. Dentro de una transacción (escritura de
+        carga_varios, CSV en MySQL) el UPDATE se hace con una conexión propia,
+        de lo contrario la página de estado no lo vería hasta el final. En
+        SQLite se usa la misma conexión porque la base queda bloqueada mientras
+        se escribe.
+    '''
+    cargas = CargaCredito.objects.filter(pk=carga.pk)
+    aparte = []
+
+    def progreso(reporte):
+        valores = {campo: reporte[campo] for campo in CAMPOS_REPORTE}
+        if not connection.in_atomic_block or connection.vendor == 'sqlite':
+            cargas.update(**valores)
+            return
+        if not aparte:
+            aparte.append(connections.create_connection(DEFAULT_DB_ALIAS))
+        conexion, opciones = aparte[0], CargaCredito._meta
+        columnas = ', '.join(f'{conexion.ops.quote_name(opciones.get_field(campo).column)} = %s' 
+            for campo in valores)
+        with conexion.cursor() as cursor:
+            cursor.execute(f'''UPDATE {conexion.ops.quote_name(opciones.db_table)} SET {columnas} 
+                WHERE {conexion.ops.quote_name(opciones.pk.column)} = %s''', 
+                [*valores.values(), opciones.pk.get_db_prep_value(carga.pk, conexion)])
+
+    def cierra():
+        for conexion in aparte:
+            conexion.close()
+
+    return progreso, cierra
+
+
+##########################################################################
+# Escritura
+##########################################################################
+def _valida_tomo(crear_tomo, usuario):
+    if crear_tomo and usuario is None:
+        raise ValueError(_('Se requiere un usuario para crear los tomos'))
+
+def _insert_datos(datos, actualizar=False, usuario=None, crear_tomo=False):
+    '''
+        Guarda el lote indicado, los catálogos se resuelven con una consulta
+        por tabla. Devuelve la cantidad de créditos insertados, actualizados y
+        sin cambios.
+    '''
+    llaves = {
+        'clientes': _insert_clientes(datos['clientes']),
+        'oficinas': _insert_oficinas(datos['oficinas']),
+        'monedas': _insert_monedas(datos['monedas']),
+        'productos': _insert_productos(datos['productos']),
+    }
+    return _insert_creditos(datos['creditos'], llaves, actualizar, usuario, crear_tomo)
+
+def _insert_catalogo(modelo, campo, datos, nuevo):
+    '''
+        Inserta los registros del catálogo que no existen (datos: llave -> valor)
+        y devuelve el diccionario llave -> id de todos los registros indicados
+    '''
+    llaves = dict(modelo.objects.filter(**{f'{campo}__in': list(datos)}).values_list(campo, 'id'))
+    inserts = [nuevo(llave, valor) for llave, valor in datos.items() if llave not in llaves]
+    modelo.objects.bulk_create(inserts, batch_size=1500)
+    llaves.update((getattr(obj, campo), obj.id) for obj in inserts)
+    return llaves
+
+def _insert_clientes(datos):
+    return _insert_catalogo(Cliente, 'codigo', datos, 
+        lambda codigo, nombre: Cliente(codigo=codigo, nombre=nombre))
+
+def _insert_oficinas(datos):
+    return _insert_catalogo(Oficina, 'numero', datos, 
+        lambda numero, descripcion: Oficina(numero=numero, descripcion=descripcion))
+
+def _insert_monedas(datos):
+    return _insert_catalogo(Moneda, 'descripcion', datos, 
+        lambda descripcion, _valor: Moneda(descripcion=descripcion))
+
+def _insert_productos(datos):
+    return _insert_catalogo(Producto, 'descripcion', datos, 
+        lambda descripcion, _valor: Producto(descripcion=descripcion))
+
+def _insert_creditos(datos, llaves, actualizar=False, usuario=None, crear_tomo=False):
+    '''
+        Inserta los créditos nuevos (con su tomo 1 si se indica crear_tomo) y,
+        si se indica actualizar, modifica los existentes cuya huella cambió.
+        Los créditos con la misma huella no se escriben. El histórico se
+        guarda una vez por lote.
+    '''
+    existentes = {credito.numero: credito for credito in Credito.objects\
+        .filter(numero__in=list(datos)).only('id', 'numero', 'huella', 'escaneado')}
+
+    creditos, cambios, sin_cambio = [], [], 0
+    for numero, fecha, monto, mis, cod_ofi, moneda, producto, huella in datos.values():
+        credito = existentes.get(numero)
+        if credito is not None and credito.huella == huella:
+            sin_cambio += 1
+            continue
+        elif credito is None:
+            credito = Credito(numero=numero, tomos_vigentes=int(crear_tomo))
+            creditos.append(credito)
+        elif actualizar:
+            cambios.append(credito)
+        else:
+            continue
+
+        credito.fecha_concesion, credito.monto, credito.huella = fecha, monto, huella
+        credito.cliente_id, credito.oficina_id = llaves['clientes'][mis], llaves['oficinas'][cod_ofi]
+        credito.moneda_id, credito.producto_id = llaves['monedas'][moneda], llaves['productos'][producto]
+
+    bulk_create_with_history(creditos, Credito, batch_size=1500, default_user=usuario,
+        default_change_reason='Carga masiva')
+    if crear_tomo:
+        tomos = [Tomo(numero=1, credito_id=credito.id, comentario='Tomo habilitado', usuario=usuario)
+            for credito in creditos]
+        bulk_create_with_history(tomos, Tomo, batch_size=1500, default_user=usuario,
+            default_change_reason='Carga masiva (tomo 1)')
+    if cambios:
+        bulk_update_with_history(cambios, Credito, ['monto', 'fecha_concesion', 'cliente', 
+            'oficina', 'moneda', 'producto', 'huella'], batch_size=1500, default_user=usuario, 
+            default_change_reason='Carga masiva (actualización)')
+    return {'insertados': len(creditos), 'actualizados': len(cambios), 'sin_cambio': sin_cambio}
+
+
+##########################################################################
+# Carga nativa de CSV (MySQL)
+##########################################################################
+CAMPOS_CSV = {
+    'Cod_Cliente': 'cod_cliente', 'Cliente': 'cliente', 'Cod_ofi': 'cod_ofi', 
+    'Oficina': 'oficina', 'Moneda': 'moneda', 'Producto': 'producto', 
+    'Credito': 'credito', 'Fecha_Ini': 'fecha_ini', 'Monto': 'monto',
+}
+
+def carga_csv_mysql(ruta, actualizar=False, usuario=None, crear_tomo=False, progreso=None):
+    '''
+        Carga el CSV a una tabla temporal con LOAD DATA LOCAL INFILE y desde
+        ahí inserta clientes, oficinas, monedas, productos y créditos con
+        INSERT ... SELECT. Requiere 'local_infile' en las opciones de la base
+        de datos (ver README).
+        progreso: función que recibe el reporte luego de cada etapa
+    '''
+    _valida_tomo(crear_tomo, usuario)
+    reporte = nuevo_reporte()
+
+    def avance():
+        if progreso:
+            progreso(reporte)
+    with open(ruta, 'rb') as archivo:
+        linea = archivo.readline()
+    fin_linea = '\r\n' if linea.endswith(b'\r\n') else '\n'
+    linea = linea.decode('utf-8-sig').strip()
+    separador = _separador_csv(linea)
+    encabezado = [columna.strip() for columna in next(csv.reader([linea], delimiter=separador))]
+    faltantes = [columna for columna in COLUMNAS if columna not in encabezado]
+    if faltantes:
+        agrega_error(reporte, 1, _('Columnas faltantes: ')+', '.join(faltantes))
+        return reporte
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT @@SESSION.sql_mode')
+        sql_mode = cursor.fetchone()[0]
+        # fechas y montos inválidos quedan en NULL (con advertencia) para reportarlos
+        cursor.execute("SET SESSION sql_mode = ''")
+        try:
+            _tabla_temporal(cursor)
+            reporte['leidos'] = _carga_temporal(cursor, ruta, encabezado, separador, fin_linea)
+            avance()
+            _valida_temporal(cursor, reporte)
+            avance()
+            _merge_catalogos(cursor)
+            _merge_creditos(cursor, reporte, actualizar, usuario, avance)
+            if crear_tomo:
+                _merge_tomos(cursor, usuario)
+        finally:
+            cursor.execute('DROP TEMPORARY TABLE IF EXISTS carga_credito_unica, carga_credito')
+            cursor.execute('SET SESSION sql_mode = %s', [sql_mode])
+
+    reporte['omitidos'] = reporte['leidos'] - reporte['insertados'] - reporte['actualizados']\
+        - reporte['sin_cambio']
+    return reporte
+
+def _tabla_temporal(cursor):
+    largo = lambda modelo, campo: modelo._meta.get_field(campo).max_length
+    cursor.execute(f'''
+        CREATE TEMPORARY TABLE carga_credito (
+            fila INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+            cod_cliente VARCHAR(20), cliente VARCHAR({largo(Cliente, 'nombre')}),
+            cod_ofi VARCHAR(20), oficina VARCHAR({largo(Oficina, 'descripcion')}),
+            moneda VARCHAR({largo(Moneda, 'descripcion')}), 
+            producto VARCHAR({largo(Producto, 'descripcion')}),
+            credito VARCHAR({largo(Credito, 'numero')}), fecha_ini VARCHAR(30), monto VARCHAR(30),
+            codigo_cliente INT UNSIGNED, numero_oficina INT UNSIGNED,
+            fecha DATE, importe DECIMAL(18,2), huella CHAR(32),
+            valido BOOL NOT NULL DEFAULT FALSE, usar BOOL NOT NULL DEFAULT FALSE,
+            nuevo BOOL NOT NULL DEFAULT FALSE, cambio BOOL NOT NULL DEFAULT FALSE,
+            INDEX (credito)
+        ) CHARACTER SET utf8mb4''')
+
+def _carga_temporal(cursor, ruta, encabezado, separador, fin_linea):
+    variables = [f'@v{i}' for i in range(len(encabezado))]
+    asignaciones = [f"{CAMPOS_CSV[columna]} = NULLIF(TRIM(@v{i}), '')" 
+        for i, columna in enumerate(encabezado) if columna in CAMPOS_CSV]
+    cursor.execute(f'''
+        LOAD DATA LOCAL INFILE %s INTO TABLE carga_credito CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY %s OPTIONALLY ENCLOSED BY '"' LINES TERMINATED BY %s
+        IGNORE 1 LINES ({', '.join(variables)}) SET {', '.join(asignaciones)}''', 
+        [ruta, separador, fin_linea])
+    return cursor.rowcount
+
+def _valida_temporal(cursor, reporte):
+    cursor.execute('''
+        UPDATE carga_credito SET
+            codigo_cliente = IF(cod_cliente REGEXP '^[0-9]+$', cod_cliente, NULL),
+            numero_oficina = IF(cod_ofi REGEXP '^[0-9]+$', cod_ofi, NULL),
+            importe = IF(monto REGEXP '^-?[0-9]+([.][0-9]+)?$', monto, NULL),
+            fecha = STR_TO_DATE(fecha_ini, '%d/%m/%Y')''')
+    cursor.execute('''
+        UPDATE carga_credito SET valido = (cliente IS NOT NULL AND oficina IS NOT NULL 
+            AND moneda IS NOT NULL AND producto IS NOT NULL AND credito IS NOT NULL
+            AND codigo_cliente IS NOT NULL AND numero_oficina IS NOT NULL
+            AND importe IS NOT NULL AND fecha IS NOT NULL)''')
+
+    cursor.execute('SELECT COUNT(*), COALESCE(SUM(NOT valido), 0) FROM carga_credito')
+    reporte['leidos'], reporte['cant_errores'] = [int(valor) for valor in cursor.fetchone()]
+    cursor.execute(f'''
+        SELECT fila + 1, CASE
+            WHEN cod_cliente IS NULL OR cliente IS NULL OR cod_ofi IS NULL OR oficina IS NULL
+                OR moneda IS NULL OR producto IS NULL OR credito IS NULL 
+                OR fecha_ini IS NULL OR monto IS NULL THEN 'columna:'
+            WHEN codigo_cliente IS NULL OR numero_oficina IS NULL THEN 'codigo:'
+            WHEN importe IS NULL THEN CONCAT('monto:', monto)
+            ELSE CONCAT('fecha:', fecha_ini) END
+        FROM carga_credito WHERE NOT valido ORDER BY fila LIMIT {MAX_ERRORES}''')
+    mensajes = {
+        'columna': _('Columna sin valor'),
+        'codigo': _('Código de cliente u oficina no numérico'),
+        'monto': _('Monto inválido: '),
+        'fecha': _('Fecha inválida: '),
+    }
+    for fila, error in cursor.fetchall():
+        tipo, _dos_puntos, valor = error.partition(':')
+        reporte['errores'].append({'fila': fila, 'mensaje': mensajes[tipo]+valor})
+
+    # primera aparición de cada crédito (MySQL no permite abrir dos veces una tabla temporal)
+    cursor.execute('''
+        CREATE TEMPORARY TABLE carga_credito_unica (fila INT UNSIGNED PRIMARY KEY)
+        SELECT MIN(fila) AS fila FROM carga_credito WHERE valido GROUP BY credito''')
+    cursor.execute('''
+        UPDATE carga_credito s JOIN carga_credito_unica u ON u.fila = s.fila SET s.usar = TRUE''')
+    reporte['omitidos'] = reporte['leidos'] - cursor.rowcount   # inválidos y repetidos
+
+def _merge_catalogos(cursor):
+    catalogos = [
+        (Cliente, 'codigo', 'nombre', 'codigo_cliente', 'cliente'),
+        (Oficina, 'numero', 'descripcion', 'numero_oficina', 'oficina'),
+        (Moneda, 'descripcion', None, 'moneda', None),
+        (Producto, 'descripcion', None, 'producto', None),
+    ]
+    for modelo, llave, valor, col_llave, col_valor in catalogos:
+        tabla = modelo._meta.db_table
+        columnas = f'id, {llave}' + (f', {valor}' if valor else '')
+        seleccion = f'{col_llave} AS llave' + (f', MIN({col_valor}) AS valor' if valor else '')
+        cursor.execute(f'''
+            INSERT INTO {tabla} ({columnas})
+            SELECT REPLACE(UUID(), '-', ''), t.llave{', t.valor' if valor else ''} FROM (
+                SELECT {seleccion} FROM carga_credito WHERE usar GROUP BY {col_llave}) t
+            LEFT JOIN {tabla} c ON c.{llave} = t.llave
+            WHERE c.id IS NULL''')
+
+def _merge_creditos(cursor, reporte, actualizar, usuario, avance):
+    credito = Credito._meta.db_table
+    catalogos = f'''
+        JOIN {Cliente._meta.db_table} cl ON cl.codigo = s.codigo_cliente
+        JOIN {Oficina._meta.db_table} ofi ON ofi.numero = s.numero_oficina
+        JOIN {Moneda._meta.db_table} mo ON mo.descripcion = s.moneda
+        JOIN {Producto._meta.db_table} pr ON pr.descripcion = s.producto'''
+    # misma huella que huella_credito()
+    cursor.execute('''
+        UPDATE carga_credito SET huella = MD5(CONCAT_WS('|', credito, DATE_FORMAT(fecha, '%Y-%m-%d'),
+            importe, codigo_cliente, numero_oficina, moneda, producto))
+        WHERE usar''')
+    cursor.execute(f'''
+        UPDATE carga_credito s LEFT JOIN {credito} c ON c.numero = s.credito
+        SET s.nuevo = (c.id IS NULL),
+            s.cambio = (c.id IS NOT NULL AND NOT (c.huella <=> s.huella))
+        WHERE s.usar''')
+    cursor.execute('SELECT COUNT(*) FROM carga_credito WHERE usar AND NOT nuevo AND NOT cambio')
+    reporte['sin_cambio'] = cursor.fetchone()[0]
+
+    cursor.execute(f'''
+        INSERT INTO {credito} (id, numero, monto, escaneado, fecha_concesion, fecha_ingreso,
+            huella, tomos_vigentes, cliente_id, moneda_id, oficina_id, producto_id)
+        SELECT REPLACE(UUID(), '-', ''), s.credito, s.importe, FALSE, s.fecha, NOW(6),
+            s.huella, 0, cl.id, mo.id, ofi.id, pr.id
+        FROM carga_credito s {catalogos}
+        WHERE s.usar AND s.nuevo''')
+    reporte['insertados'] = cursor.rowcount
+    _historico(cursor, Credito, 's.nuevo', '+', 'Carga masiva', usuario)
+    avance()
+
+    if actualizar:
+        cursor.execute(f'''
+            UPDATE {credito} c JOIN carga_credito s ON s.credito = c.numero {catalogos}
+            SET c.monto = s.importe, c.fecha_concesion = s.fecha, c.huella = s.huella,
+                c.cliente_id = cl.id, c.oficina_id = ofi.id, c.moneda_id = mo.id, 
+                c.producto_id = pr.id
+            WHERE s.usar AND s.cambio''')
+        reporte['actualizados'] = cursor.rowcount
+        _historico(cursor, Credito, 's.cambio', '~', 'Carga masiva (actualización)', usuario)
+        avance()
+
+def _merge_tomos(cursor, usuario):
+    ''' Crea el tomo 1 de los créditos insertados desde la tabla temporal '''
+    cursor.execute(f'''
+        INSERT INTO {Tomo._meta.db_table} (id, numero, vigente, fecha_modificacion, comentario,
+            credito_id, usuario_id)
+        SELECT REPLACE(UUID(), '-', ''), 1, TRUE, NOW(6), 'Tomo habilitado', c.id, %s
+        FROM {Credito._meta.db_table} c JOIN carga_credito s ON s.credito = c.numero
+        WHERE s.usar AND s.nuevo''', [usuario.pk])
+    cursor.execute(f'''
+        UPDATE {Credito._meta.db_table} c JOIN carga_credito s ON s.credito = c.numero
+        SET c.tomos_vigentes = 1
+        WHERE s.usar AND s.nuevo''')
+    _historico(cursor, Tomo, 's.nuevo', '+', 'Carga masiva (tomo 1)', usuario)
+
+def _historico(cursor, modelo, condicion, tipo, razon, usuario):
+    '''
+        Registra el histórico de los créditos marcados en la tabla temporal
+        (modelo Credito) o de sus tomos (modelo Tomo)
+    '''
+    historico = modelo.history.model
+    columnas = [campo.column for campo in modelo._meta.fields 
+        if campo.name not in historico._history_excluded_fields]
+    if modelo is Tomo:
+        alias, origen = 't', f'''{Tomo._meta.db_table} t 
+            JOIN {Credito._meta.db_table} c ON c.id = t.credito_id'''
+    else:
+        alias, origen = 'c', f'{Credito._meta.db_table} c'
+    cursor.execute(f'''
+        INSERT INTO {historico._meta.db_table} ({', '.join(columnas)}, history_date, 
+            history_change_reason, history_type, history_user_id)
+        SELECT {', '.join(f'{alias}.{columna}' for columna in columnas)}, NOW(6), %s, %s, %s
+        FROM {origen} JOIN carga_credito s ON s.credito = c.numero
+        WHERE s.usar AND {condicion}''', [razon, tipo, usuario.pk if usuario else None])
@@ -0,0 +1,111 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Q, F, Case, When, Count, Sum
+from django.template.loader import get_template
+from django.utils import timezone
+
+from .models import Correo, Movimiento
+
+
+##########################################################################
+# Bandeja de salida
+##########################################################################
+ESPERA = 60         # segundos antes del primer reintento, se duplica en cada intento
+MAX_INTENTOS = 6
+
+def encola_correo(asunto, remitente, destinatarios, plantilla, contexto):
+    '''
+        Registra el correo en la bandeja de salida. Se llama dentro de la
+        transacción de la operación: si esta se revierte, el correo no queda.
+    '''
+    destinatarios = [correo for correo in destinatarios if correo]
+    if not destinatarios:
+        return None
+    return Correo.objects.create(asunto=asunto, remitente=remitente or '',
+        destinatarios=destinatarios, contenido=get_template(plantilla).render(contexto))
+
+def envia_pendientes(lote=50):
+    '''
+        Envía los correos pendientes cuyo intento ya corresponde, abriendo
+        una sola conexión con el servidor para todo el lote. Los que fallan
+        se reintentan con espera creciente y, luego de MAX_INTENTOS, quedan
+        en error. Devuelve la cantidad de enviados y fallidos.
+    '''
+    correos = list(Correo.objects.filter(estado=Correo.PENDIENTE, siguiente_intento__lte=timezone.now())\
+        .order_by('siguiente_intento')[:lote])
+    if not correos:
+        return 0, 0
+
+    enviados = 0
+    conexion = get_connection(fail_silently=False)
+    try:
+        conexion.open()
+    except Exception as error:
+        for correo in correos:
+            _reintento(correo, error)
+    else:
+        for correo in correos:
+            try:
+                correo.mensaje(conexion).send()
+                correo.estado, correo.fecha_envio = Correo.ENVIADO, timezone.now()
+                enviados += 1
+            except Exception as error:
+                _reintento(correo, error)
+        conexion.close()
+
+    Correo.objects.bulk_update(correos, ['estado', 'intentos', 'siguiente_intento', 'fecha_envio', 'error'],
+        batch_size=1500)
+    return enviados, len(correos) - enviados
+
+def _reintento(correo, error):
+    correo.intentos += 1
+    correo.error = str(error) or error.__class__.__name__
+    if correo.intentos >= MAX_INTENTOS:
+        correo.estado = Correo.ERROR
+    else:
+        correo.siguiente_intento = timezone.now() + timedelta(seconds=ESPERA * 2**(correo.intentos-1))
+
+
+##########################################################################
+# Resumen por encargado
+##########################################################################
+def resumen_movimientos(desde, hasta):
+    '''
+        Traslados hacia y egresos desde las bodegas con resumen diario en el
+        periodo, agrupados en una sola consulta por encargado, bodega, tipo y
+        usuario (cantidad de movimientos y de tomos).
+    '''
+    traslado = Q(tipo=Movimiento.TRASLADO)
+    return Movimiento.objects.filter(fecha__gte=desde, fecha__lt=hasta)\
+        .filter(traslado & Q(bodega_destino__correo_resumen=True) | 
+            ~traslado & Q(bodega_origen__correo_resumen=True))\
+        .annotate(
+            encargado=Case(When(traslado, then=F('bodega_destino__encargado__email')), 
+                default=F('bodega_origen__encargado__email')),
+            bodega=Case(When(traslado, then=F('bodega_destino__nombre')), 
+                default=F('bodega_origen__nombre')))\
+        .values('encargado', 'bodega', 'tipo', 'usuario__username')\
+        .annotate(movimientos=Count('id'), cantidad=Sum('tomos'))\
+        .order_by('encargado', 'bodega', 'tipo', 'usuario__username')
+
+def encola_resumenes(desde, hasta):
+    ''' Registra en la bandeja de salida un resumen por encargado, devuelve la cantidad '''
+    tipos = dict(Movimiento.TIPOS)
+    resumenes = defaultdict(list)
+    for fila in resumen_movimientos(desde, hasta):
+        fila['tipo'] = tipos[fila['tipo']]
+        resumenes[fila.pop('encargado')].append(fila)
+
+    with transaction.atomic():
+        for encargado, filas in resumenes.items():
+            context = {
+                'title': 'Resumen de Expedientes',
+                'message': f'Traslados y egresos del {desde:%d-%m-%Y %H:%M} al {hasta:%d-%m-%Y %H:%M}:',
+                'object_list': filas,
+                'tomos': sum(fila['cantidad'] for fila in filas),
+            }
+            encola_correo('Resumen de Expedientes', None, [encargado], 'mails/resumen.html', context)
+    return len(resumenes)
@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .acceso import bodegas_personal
+from .models import Tomo, EnvioTomo, Movimiento
+from .ocupacion import ajusta_ocupacion
+
+
+##########################################################################
+# Lista de envío por usuario
+##########################################################################
+def tomos_envio(usuario):
+    ''' Tomos en la lista de envío del usuario, en una sola consulta '''
+    return Tomo.objects.filter(envio_tomo__usuario=usuario)\
+        .select_related('credito', 'caja').order_by('credito__numero', 'numero')
+
+def agrega_envio(usuario, pares):
+    '''
+        Agrega a la lista del usuario los tomos indicados como pares (credito,
+        tomo) con una consulta y una inserción masiva. Únicamente se aceptan
+        tomos ingresados en cajas de bodegas donde el usuario es personal.
+        Devuelve la cantidad de tomos agregados y los pares no disponibles.
+    '''
+    disponibles = {(credito, numero): llave for llave, credito, numero 
+        in Tomo.objects.filter(credito__numero__in={credito for credito, numero in pares}, 
+            vigente=True, caja__isnull=False, bodega__in=bodegas_personal(usuario))\
+        .values_list('id', 'credito__numero', 'numero')}
+    llaves = {disponibles[par] for par in pares if par in disponibles}
+    previos = set(EnvioTomo.objects.filter(usuario=usuario, tomo__in=llaves).values_list('tomo_id', flat=True))
+
+    with transaction.atomic():
+        EnvioTomo.objects.bulk_create([EnvioTomo(usuario=usuario, tomo_id=llave) 
+            for llave in llaves - previos], batch_size=1500, ignore_conflicts=True)
+    return len(llaves - previos), [par for par in pares if par not in disponibles]
+
+def quita_envio(usuario, tomos=None):
+    ''' Quita de la lista del usuario los tomos indicados (llaves), todos si no se indican '''
+    envios = EnvioTomo.objects.filter(usuario=usuario)
+    if tomos is not None:
+        envios = envios.filter(tomo__in=tomos)
+    return envios.delete()[0]
+
+
+##########################################################################
+# Salida de tomos
+##########################################################################
+def salida_envio(usuario, datos, razon, lote=1500):
+    '''
+        Saca de sus cajas los tomos de la lista del usuario en una sola
+        transacción: los bloquea y lee una vez (guardando la caja que tenían
+        en "caja_anterior"), registra un Movimiento con "datos" por bodega de
+        origen, actualiza los tomos con UPDATE por lotes de llaves, crea su
+        historial en una inserción masiva, descuenta la ocupación y vacía la
+        lista. Devuelve los movimientos y los tomos leídos, para el correo.
+    '''
+    with transaction.atomic():
+        tomos = list(Tomo.objects.select_for_update().filter(envio_tomo__usuario=usuario)\
+            .select_related('credito', 'caja').order_by('credito__numero', 'numero'))
+        if not tomos:
+            return [], tomos
+
+        grupos = defaultdict(list)
+        for tomo in tomos:
+            grupos[tomo.bodega_id].append(tomo)
+        movimientos = Movimiento.objects.bulk_create([Movimiento(bodega_origen_id=bodega, 
+            tomos=len(grupo), usuario=usuario, **datos) for bodega, grupo in grupos.items()])
+
+        fecha = timezone.now()
+        salidas = defaultdict(int)
+        for movimiento in movimientos:
+            grupo, comentario = grupos[movimiento.bodega_origen_id], str(movimiento)
+            for tomo in grupo:
+                if tomo.caja_id:
+                    salidas[tomo.caja_id] -= 1
+                tomo.caja_anterior = tomo.caja
+                tomo.comentario, tomo.movimiento, tomo.caja, tomo.bodega = comentario, movimiento, None, None
+                tomo.usuario, tomo.fecha_modificacion = usuario, fecha
+
+            llaves = [tomo.id for tomo in grupo]
+            for inicio in range(0, len(llaves), lote):
+                Tomo.objects.filter(id__in=llaves[inicio:inicio+lote]).update(comentario=comentario, 
+                    movimiento=movimiento, caja=None, bodega=None, usuario=usuario, fecha_modificacion=fecha)
+        Tomo.history.bulk_history_create(tomos, batch_size=lote, update=True, 
+            default_user=usuario, default_change_reason=razon, default_date=fecha)
+        ajusta_ocupacion(salidas)
+        quita_envio(usuario, [tomo.id for tomo in tomos])
+    return movimientos, tomos
@@ -0,0 +1,250 @@
+import uuid
+
+from string import ascii_uppercase
+from simple_history.utils import bulk_create_with_history
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.functions import Length
+from django.urls import reverse
+from django.utils.translation import gettext as _
+
+from .models import Estante, Nivel, Posicion, Caja, Tomo, codigo_caja, CAPACIDAD_CAJA
+
+
+##########################################################################
+# Códigos
+##########################################################################
+def codigo_estante(indice):
+    '''
+        Código del estante en la posición indicada (base 0): A..Z, AA..ZZ,
+        AAA..ZZZ
+    '''
+    codigo = ''
+    indice += 1
+    while indice:
+        indice, residuo = divmod(indice-1, 26)
+        codigo = ascii_uppercase[residuo] + codigo
+    return codigo
+
+def codigos_estante(cantidad):
+    return [codigo_estante(i) for i in range(cantidad)]
+
+
+##########################################################################
+# Generación
+##########################################################################
+def genera_estructura(bodega, estantes, niveles, posiciones, cajas, usuario=None, simular=False,
+        capacidad=CAPACIDAD_CAJA):
+    '''
+        Completa la estructura de la bodega hasta la cantidad indicada en cada
+        nivel, únicamente bajo los registros vigentes. Se hace una consulta por
+        tabla para conocer lo existente y una inserción masiva por tabla, todo
+        en una transacción. Con simular no se guarda nada. Las cajas nuevas se
+        crean con la capacidad indicada.
+        Devuelve la cantidad de registros agregados (o por agregar) por tabla.
+    '''
+    nuevos = {}
+
+    existentes = Estante.objects.filter(bodega=bodega).values_list('id', 'codigo', 'vigente')
+    actuales = {codigo for llave, codigo, vigente in existentes}
+    nuevos['estantes'] = [Estante(codigo=codigo, bodega=bodega)
+        for codigo in codigos_estante(estantes) if codigo not in actuales]
+    padres = [llave for llave, codigo, vigente in existentes if vigente]\
+        + [estante.id for estante in nuevos['estantes']]
+    codigos = {llave: f'{bodega.codigo}-{codigo}' for llave, codigo, vigente in existentes}
+    codigos.update({estante.id: f'{bodega.codigo}-{estante.codigo}' for estante in nuevos['estantes']})
+
+    nuevos['niveles'], padres, codigos = _faltantes(Nivel, 'estante', padres, codigos, niveles,
+        Nivel.objects.filter(estante__bodega=bodega))
+    nuevos['posiciones'], padres, codigos = _faltantes(Posicion, 'nivel', padres, codigos, 
+        posiciones, Posicion.objects.filter(nivel__estante__bodega=bodega))
+    nuevos['cajas'], padres, codigos = _faltantes(Caja, 'posicion', padres, codigos, cajas,
+        Caja.objects.filter(posicion__nivel__estante__bodega=bodega))
+    for caja in nuevos['cajas']:
+        caja.codigo, caja.bodega, caja.capacidad = codigos[caja.id], bodega, capacidad
+
+    if not simular:
+        with transaction.atomic():
+            Estante.objects.bulk_create(nuevos['estantes'], batch_size=1500)
+            Nivel.objects.bulk_create(nuevos['niveles'], batch_size=1500)
+            Posicion.objects.bulk_create(nuevos['posiciones'], batch_size=1500)
+            bulk_create_with_history(nuevos['cajas'], Caja, batch_size=1500, default_user=usuario,
+                default_change_reason='Genera estructura')
+        invalida_estructura(bodega.id)
+    return {nivel: len(registros) for nivel, registros in nuevos.items()}
+
+def _faltantes(modelo, padre, padres, codigos, cantidad, queryset):
+    '''
+        Registros de "modelo" numerados 1..cantidad que no existen bajo cada
+        padre. Devuelve además las llaves de los vigentes (existentes y nuevos),
+        que serán los padres del siguiente nivel, y los códigos de ubicación
+        de todos a partir de los códigos de los padres.
+    '''
+    existentes = queryset.values_list('id', f'{padre}_id', 'numero', 'vigente')
+    numeros = {(llave_padre, numero) for llave, llave_padre, numero, vigente in existentes}
+    nuevos = [modelo(numero=numero, **{f'{padre}_id': llave})
+        for llave in padres for numero in range(1, cantidad+1)
+        if (llave, numero) not in numeros]
+    vigentes = [llave for llave, llave_padre, numero, vigente in existentes if vigente]\
+        + [registro.id for registro in nuevos]
+    codigos = {**{llave: f'{codigos[llave_padre]}-{numero:02d}' 
+            for llave, llave_padre, numero, vigente in existentes},
+        **{registro.id: f'{codigos[getattr(registro, padre+"_id")]}-{registro.numero:02d}' 
+            for registro in nuevos}}
+    return nuevos, vigentes, codigos
+
+
+##########################################################################
+# Clonación
+##########################################################################
+def clona_estructura(origen, destino, usuario=None):
+    '''
+        Copia estantes, niveles, posiciones y cajas (con su estado) de la
+        bodega origen a la bodega destino, que no debe tener estructura. Las
+        llaves se reasignan en memoria y cada tabla se inserta de forma
+        masiva en una sola transacción.
+        Devuelve la cantidad de registros copiados por tabla.
+    '''
+    if Estante.objects.filter(bodega=destino).exists():
+        raise ValueError(_('La bodega destino ya tiene estructura'))
+
+    estantes = {llave: Estante(codigo=codigo, vigente=vigente, bodega=destino)
+        for llave, codigo, vigente in Estante.objects.filter(bodega=origen)\
+            .values_list('id', 'codigo', 'vigente')}
+    niveles = _copia(Nivel, 'estante', estantes, Nivel.objects.filter(estante__bodega=origen))
+    posiciones = _copia(Posicion, 'nivel', niveles, 
+        Posicion.objects.filter(nivel__estante__bodega=origen))
+    cajas = _copia(Caja, 'posicion', posiciones, 
+        Caja.objects.filter(posicion__nivel__estante__bodega=origen), 'capacidad')
+
+    codigos = {estante.id: f'{destino.codigo}-{estante.codigo}' for estante in estantes.values()}
+    for registros, padre in ((niveles, 'estante'), (posiciones, 'nivel'), (cajas, 'posicion')):
+        codigos.update({registro.id: f'{codigos[getattr(registro, padre+"_id")]}-{registro.numero:02d}'
+            for registro in registros.values()})
+    for caja in cajas.values():
+        caja.codigo, caja.bodega = codigos[caja.id], destino
+
+    with transaction.atomic():
+        Estante.objects.bulk_create(estantes.values(), batch_size=1500)
+        Nivel.objects.bulk_create(niveles.values(), batch_size=1500)
+        Posicion.objects.bulk_create(posiciones.values(), batch_size=1500)
+        bulk_create_with_history(list(cajas.values()), Caja, batch_size=1500, default_user=usuario,
+            default_change_reason=f'Clona estructura de {origen.codigo}')
+    invalida_estructura(destino.id)
+    return {'estantes': len(estantes), 'niveles': len(niveles), 
+        'posiciones': len(posiciones), 'cajas': len(cajas)}
+
+def _copia(modelo, padre, padres, queryset, *campos):
+    '''
+        Copias de los registros del queryset apuntando a los padres ya copiados
+        (llave original -> copia), con numero, vigente y los campos indicados
+    '''
+    return {llave: modelo(numero=numero, vigente=vigente, **{f'{padre}_id': padres[llave_padre].id},
+            **dict(zip(campos, valores)))
+        for llave, llave_padre, numero, vigente, *valores 
+            in queryset.values_list('id', f'{padre}_id', 'numero', 'vigente', *campos).iterator()}
+
+
+##########################################################################
+# Códigos de ubicación
+##########################################################################
+def actualiza_codigos(cajas):
+    '''
+        Recalcula Caja.codigo y Caja.bodega de las cajas indicadas (queryset),
+        necesario cuando cambia el código de la bodega o luego de migrar.
+        Devuelve la cantidad de cajas modificadas.
+    '''
+    cambios = []
+    datos = cajas.values_list('id', 'codigo', 'bodega_id', 'posicion__nivel__estante__bodega_id',
+        'posicion__nivel__estante__bodega__codigo', 'posicion__nivel__estante__codigo', 
+        'posicion__nivel__numero', 'posicion__numero', 'numero')
+    for llave, actual, bodega_actual, bodega, *ubicacion in datos.iterator():
+        codigo = codigo_caja(*ubicacion)
+        if codigo != actual or bodega != bodega_actual:
+            cambios.append(Caja(id=llave, codigo=codigo, bodega_id=bodega))
+
+    with transaction.atomic():
+        Caja.objects.bulk_update(cambios, ['codigo', 'bodega'], batch_size=1500)
+    return len(cambios)
+
+def actualiza_bodegas(tomos):
+    '''
+        Recalcula Tomo.bodega (la bodega de su caja, vacía si no está en una)
+        de los tomos indicados (queryset). Devuelve la cantidad de tomos
+        modificados.
+    '''
+    cambios = [Tomo(id=llave, bodega_id=bodega) for llave, actual, bodega 
+        in tomos.values_list('id', 'bodega_id', 'caja__posicion__nivel__estante__bodega_id').iterator()
+        if bodega != actual]
+
+    with transaction.atomic():
+        Tomo.objects.bulk_update(cambios, ['bodega'], batch_size=1500)
+    return len(cambios)
+
+
+##########################################################################
+# Versión de la estructura (caché de las grillas)
+##########################################################################
+def _clave_estructura(bodega_id):
+    return f'documentos:estructura:{bodega_id}'
+
+def version_estructura(bodega_id):
+    ''' Forma parte de la llave de las grillas en caché de la bodega '''
+    return cache.get_or_set(_clave_estructura(bodega_id), 1, None)
+
+def invalida_estructura(*bodegas):
+    ''' Descarta las grillas de las bodegas (cambio de estructura, estado u ocupación) '''
+    for bodega_id in bodegas:
+        try:
+            cache.incr(_clave_estructura(bodega_id))
+        except ValueError:
+            cache.set(_clave_estructura(bodega_id), 1, None)
+
+
+##########################################################################
+# Grillas
+##########################################################################
+CERO = uuid.UUID(int=0)
+
+def _ruta(nombre):
+    ''' URL de la vista con "{}" en lugar de la llave, se resuelve una sola vez '''
+    return reverse(nombre, kwargs={'pk': CERO}).replace(str(CERO), '{}')
+
+def grilla(registros, prefijo, vista_fila, vista_celda):
+    '''
+        Matriz de la estructura a partir de una sola consulta ordenada de
+        tuplas (llave_fila, fila, llave_celda, numero, ocupacion). Las celdas
+        que no existen quedan en None y la intensidad de cada celda es su
+        ocupación respecto a la mayor de la grilla.
+    '''
+    ruta_fila, ruta_celda = _ruta(vista_fila), _ruta(vista_celda)
+    filas, columnas, maximo = {}, 0, 0
+    for llave_fila, fila, llave, numero, ocupacion in registros:
+        if llave_fila not in filas:
+            codigo = f'{prefijo}-{fila:02d}' if isinstance(fila, int) else f'{prefijo}-{fila}'
+            filas[llave_fila] = {'etiqueta': fila, 'titulo': codigo, 
+                'url': ruta_fila.format(llave_fila), 'celdas': {}}
+        filas[llave_fila]['celdas'][numero] = {'numero': numero, 'ocupacion': ocupacion,
+            'titulo': f"{filas[llave_fila]['titulo']}-{numero:02d}", 'url': ruta_celda.format(llave)}
+        columnas, maximo = max(columnas, numero), max(maximo, ocupacion)
+
+    for fila in filas.values():
+        for celda in fila['celdas'].values():
+            celda['proporcion'] = f"{celda['ocupacion']/maximo:.2f}" if maximo else '0.00'
+        fila['celdas'] = [fila['celdas'].get(numero) for numero in range(1, columnas+1)]
+    return {'filas': list(filas.values()), 'max_columnas': columnas}
+
+def grilla_bodega(bodega):
+    ''' Estantes (filas) por niveles (columnas) '''
+    registros = Nivel.objects.filter(estante__bodega=bodega)\
+        .order_by(Length('estante__codigo'), 'estante__codigo', 'numero')\
+        .values_list('estante_id', 'estante__codigo', 'id', 'numero', 'ocupacion')
+    return grilla(registros, bodega.codigo, 'documentos:estante_view', 'documentos:nivel_view')
+
+def grilla_estante(estante):
+    ''' Niveles (filas) por posiciones (columnas) '''
+    registros = Posicion.objects.filter(nivel__estante=estante)\
+        .order_by('nivel__numero', 'numero')\
+        .values_list('nivel_id', 'nivel__numero', 'id', 'numero', 'ocupacion')
+    return grilla(registros, str(estante), 'documentos:nivel_view', 'documentos:posicion_view')
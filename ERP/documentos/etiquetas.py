@@ -0,0 +1,290 @@
+import hashlib
+import tempfile
+import zlib
+
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Length
+from django.http import FileResponse, StreamingHttpResponse, Http404
+
+
+Etiqueta = namedtuple('Etiqueta', ['codigo', 'titulo', 'lineas'])
+
+##########################################################################
+# Código 39 (barra/espacio alternados, 1 = elemento ancho)
+##########################################################################
+CODIGO39 = {
+    '0': '000110100', '1': '100100001', '2': '001100001', '3': '101100000',
+    '4': '000110001', '5': '100110000', '6': '001110000', '7': '000100101',
+    '8': '100100100', '9': '001100100', 'A': '100001001', 'B': '001001001',
+    'C': '101001000', 'D': '000011001', 'E': '100011000', 'F': '001011000',
+    'G': '000001101', 'H': '100001100', 'I': '001001100', 'J': '000011100',
+    'K': '100000011', 'L': '001000011', 'M': '101000010', 'N': '000010011',
+    'O': '100010010', 'P': '001010010', 'Q': '000000111', 'R': '100000110',
+    'S': '001000110', 'T': '000010110', 'U': '110000001', 'V': '011000001',
+    'W': '111000000', 'X': '010010001', 'Y': '110010000', 'Z': '011010000',
+    '-': '010000101', '.': '110000100', ' ': '011000100', '*': '010010100',
+    '$': '010101000', '/': '010100010', '+': '010001010', '%': '000101010',
+}
+ANCHO = 3   # módulos de un elemento ancho
+
+def barras(texto):
+    '''
+        Barras del código 39 de "texto" (se agregan los asteriscos de inicio y
+        fin). Devuelve la lista de (inicio, ancho) en módulos y el ancho total.
+    '''
+    resultado, x = [], 0
+    for caracter in f'*{texto.upper()}*':
+        for i, elemento in enumerate(CODIGO39.get(caracter, CODIGO39['-'])):
+            ancho = ANCHO if elemento=='1' else 1
+            if i % 2 == 0:
+                resultado.append((x, ancho))
+            x += ancho
+        x += 1  # separación entre caracteres
+    return resultado, x-1
+
+
+##########################################################################
+# Consultas
+##########################################################################
+def etiquetas_caja(cajas):
+    ''' Etiquetas de las cajas del queryset en orden de ubicación (una consulta) '''
+    codigos = cajas.order_by(Length('posicion__nivel__estante__codigo'), 'posicion__nivel__estante__codigo',
+        'posicion__nivel__numero', 'posicion__numero', 'numero').values_list('codigo', flat=True)
+    return [Etiqueta(codigo, None, ()) for codigo in codigos]
+
+def etiquetas_tomo(tomos):
+    ''' Etiquetas de los tomos del queryset con los datos del crédito (una consulta) '''
+    datos = tomos.order_by('credito__numero', 'numero').values_list('numero', 'credito__numero',
+        'credito__cliente__codigo', 'credito__cliente__nombre', 'credito__monto',
+        'credito__oficina__numero', 'credito__oficina__descripcion', 'credito__producto__descripcion')
+    return [Etiqueta(f'{credito}-{numero}', str(numero), (
+            f'Credito: {credito}',
+            f'Cliente: {codigo} - {nombre}',
+            f'Monto: {monto}',
+            f'Oficina: {str(oficina).zfill(4)} - {descripcion}',
+            f'Producto: {producto}'))
+        for numero, credito, codigo, nombre, monto, oficina, descripcion, producto in datos]
+
+
+##########################################################################
+# Registro de impresión
+##########################################################################
+def pendientes(queryset, impresion):
+    '''
+        Registros del queryset (cajas o tomos) sin impresión registrada, el
+        modelo de impresión usa la misma llave primaria
+    '''
+    return queryset.filter(~Exists(impresion.objects.filter(pk=OuterRef('pk'))))
+
+def registra_impresion(queryset, impresion, usuario):
+    ''' Registra como impresos los registros del queryset que aún no lo están '''
+    campo = impresion._meta.pk.attname
+    nuevos = pendientes(queryset, impresion).values_list('pk', flat=True)
+    impresion.objects.bulk_create([impresion(usuario=usuario, **{campo: llave}) for llave in nuevos],
+        batch_size=1500, ignore_conflicts=True)
+
+
+##########################################################################
+# Hojas
+##########################################################################
+# hoja oficio (8.5 x 14 pulgadas) en puntos, dos columnas
+HOJA_ANCHO, HOJA_ALTO = 612, 1008
+MARGEN_X, MARGEN_SUPERIOR, MARGEN_INFERIOR = 6, 28, 57
+COLUMNAS = 2
+COLUMNA = (HOJA_ANCHO - 2*MARGEN_X) / COLUMNAS
+BARRA_ALTO = 40
+
+def alto_etiqueta(etiquetas):
+    ''' Alto de cada etiqueta en puntos según lleve datos del crédito o no '''
+    return 216 if etiquetas and etiquetas[0].lineas else 72
+
+def paginas(etiquetas, alto):
+    ''' Separa las etiquetas por página: lista de (x, y, etiqueta), y desde arriba '''
+    filas = int((HOJA_ALTO - MARGEN_SUPERIOR - MARGEN_INFERIOR) // alto)
+    por_pagina = filas * COLUMNAS
+    for inicio in range(0, max(len(etiquetas), 1), por_pagina): # al menos una página
+        yield [(MARGEN_X + (i % COLUMNAS)*COLUMNA, MARGEN_SUPERIOR + (i // COLUMNAS)*alto, etiqueta)
+            for i, etiqueta in enumerate(etiquetas[inicio:inicio+por_pagina])]
+
+def _dibujo(etiqueta):
+    '''
+        Elementos de la etiqueta relativos a su esquina superior izquierda:
+        ('barra', x, y, ancho, alto) y ('texto', x_centro o izquierda, y_base, tamaño, texto, centrado)
+    '''
+    elementos, y = [], 10
+    if etiqueta.titulo:
+        elementos.append(('texto', COLUMNA/2, y+28, 28, etiqueta.titulo, True))
+        y += 40
+        for linea in etiqueta.lineas:
+            elementos.append(('texto', 20, y+10, 10, linea, False))
+            y += 14
+        y += 8
+    lista, modulos = barras(etiqueta.codigo)
+    modulo = min(1.2, (COLUMNA-20) / modulos)
+    inicio = (COLUMNA - modulos*modulo) / 2
+    elementos += [('barra', inicio + x*modulo, y, ancho*modulo, BARRA_ALTO) for x, ancho in lista]
+    if not etiqueta.titulo:
+        elementos.append(('texto', COLUMNA/2, y+BARRA_ALTO+12, 10, etiqueta.codigo, True))
+    return elementos
+
+
+##########################################################################
+# PDF
+##########################################################################
+def _pdf_texto(texto):
+    texto = texto.encode('cp1252', 'replace')
+    return texto.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+def _pdf_pagina(pagina):
+    contenido = []
+    for x0, y0, etiqueta in pagina:
+        for elemento in _dibujo(etiqueta):
+            if elemento[0] == 'barra':
+                _, x, y, ancho, largo = elemento
+                contenido.append(b'%.2f %.2f %.2f %.2f re f' % (x0+x, HOJA_ALTO-y0-y-largo, ancho, largo))
+            else:
+                _, x, y, tamano, texto, centrado = elemento
+                if centrado: # Courier: cada caracter mide 0.6 del tamaño
+                    x -= len(texto)*tamano*0.6/2
+                contenido.append(b'BT /F1 %d Tf %.2f %.2f Td (%s) Tj ET' % (tamano, x0+x,
+                    HOJA_ALTO-y0-y, _pdf_texto(texto)))
+    return zlib.compress(b'\n'.join(contenido))
+
+def pdf(etiquetas):
+    '''
+        Genera el PDF por partes (una página a la vez). Los objetos 1 a 3 son
+        el catálogo, el árbol de páginas y la fuente; cada página usa dos
+        objetos (contenido y página).
+    '''
+    alto = alto_etiqueta(etiquetas)
+    posiciones, largo, paginas_pdf = {}, 0, []
+
+    def objeto(numero, datos):
+        nonlocal largo
+        posiciones[numero] = largo
+        parte = b'%d 0 obj\n%s\nendobj\n' % (numero, datos)
+        largo += len(parte)
+        return parte
+
+    encabezado = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    largo = len(encabezado)
+    yield encabezado
+    yield objeto(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>')
+
+    numero = 4
+    for pagina in paginas(etiquetas, alto):
+        contenido = _pdf_pagina(pagina)
+        yield objeto(numero, b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream'
+            % (len(contenido), contenido))
+        yield objeto(numero+1, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 3 0 R >> >> >>' % (HOJA_ANCHO, HOJA_ALTO, numero))
+        paginas_pdf.append(numero+1)
+        numero += 2
+
+    hijos = b' '.join(b'%d 0 R' % pagina for pagina in paginas_pdf)
+    yield objeto(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (hijos, len(paginas_pdf)))
+    yield objeto(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+    referencias = b''.join(b'%010d 00000 n \n' % posiciones[i] for i in range(1, numero))
+    yield b'xref\n0 %d\n0000000000 65535 f \n%strailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' \
+        % (numero, referencias, numero, largo)
+
+
+##########################################################################
+# SVG (documento html con una imagen por página)
+##########################################################################
+def svg(etiquetas):
+    alto = alto_etiqueta(etiquetas)
+    yield ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><style>'
+        '@page { size: 8.5in 14in; margin: 0; } body { margin: 0; } '
+        'svg { display: block; page-break-after: always; }</style></head><body>\n').encode()
+    for pagina in paginas(etiquetas, alto):
+        partes = [f'<svg xmlns="http://www.w3.org/2000/svg" width="8.5in" height="14in" '
+            f'viewBox="0 0 {HOJA_ANCHO} {HOJA_ALTO}" font-family="Courier, monospace">']
+        for x0, y0, etiqueta in pagina:
+            for elemento in _dibujo(etiqueta):
+                if elemento[0] == 'barra':
+                    _, x, y, ancho, largo = elemento
+                    partes.append(f'<rect x="{x0+x:.2f}" y="{y0+y:.2f}" width="{ancho:.2f}" height="{largo}"/>')
+                else:
+                    _, x, y, tamano, texto, centrado = elemento
+                    ancla = ' text-anchor="middle"' if centrado else ''
+                    partes.append(f'<text x="{x0+x:.2f}" y="{y0+y:.2f}" font-size="{tamano}"{ancla}>'
+                        f'{escape(texto)}</text>')
+        partes.append('</svg>\n')
+        yield ''.join(partes).encode()
+    yield b'</body></html>\n'
+
+
+##########################################################################
+# ZPL (impresoras térmicas, una etiqueta por formato ^XA..^XZ)
+##########################################################################
+# etiqueta de 4 pulgadas de ancho a 203 dpi
+ZPL_ANCHO = 812
+
+def _zpl_texto(texto):
+    return texto.replace('^', ' ').replace('~', ' ')
+
+def zpl(etiquetas):
+    for etiqueta in etiquetas:
+        _, modulos = barras(etiqueta.codigo)
+        modulo = 2 if modulos*2 <= ZPL_ANCHO-40 else 1
+        campos, y = [], 20
+        if etiqueta.titulo:
+            campos.append(f'^FO0,{y}^A0N,60,60^FB{ZPL_ANCHO},1,0,C^FD{_zpl_texto(etiqueta.titulo)}^FS')
+            y += 80
+            for linea in etiqueta.lineas:
+                campos.append(f'^FO40,{y}^A0N,28,28^FD{_zpl_texto(linea)}^FS')
+                y += 34
+            y += 16
+        # ^B3: código 39 sin dígito verificador, texto legible debajo si no hay título
+        legible = 'N' if etiqueta.titulo else 'Y'
+        campos.append(f'^FO{(ZPL_ANCHO - modulos*modulo)//2},{y}^BY{modulo},3'
+            f'^B3N,N,100,{legible},N^FD{etiqueta.codigo.upper()}^FS')
+        partes = ['^XA', '^CI28', f'^PW{ZPL_ANCHO}', f'^LL{y+150}'] + campos + ['^XZ\n']
+        yield '\n'.join(partes).encode('utf-8')
+
+
+##########################################################################
+# Respuesta
+##########################################################################
+VERSION = 1     # cambiar si cambia el diseño, invalida las hojas guardadas
+FORMATOS = {
+    'pdf': (pdf, 'application/pdf', 'pdf', 'inline'),
+    'svg': (svg, 'text/html; charset=utf-8', 'html', 'inline'),
+    'zpl': (zpl, 'text/plain; charset=utf-8', 'zpl', 'attachment'),
+}
+
+def respuesta_etiquetas(etiquetas, formato, nombre):
+    '''
+        Devuelve la hoja de etiquetas en el formato indicado. Las hojas se
+        guardan en MEDIA_ROOT/documentos/etiquetas con el hash de su contenido,
+        por lo que una reimpresión se envía directamente del archivo.
+    '''
+    if formato not in FORMATOS:
+        raise Http404(f'Formato no soportado: {formato}')
+    generador, tipo, extension, disposicion = FORMATOS[formato]
+
+    huella = hashlib.sha1(repr((VERSION, formato, etiquetas)).encode('utf-8')).hexdigest()
+    ruta = f'documentos/etiquetas/{huella}.{extension}'
+    if default_storage.exists(ruta):
+        respuesta = FileResponse(default_storage.open(ruta, 'rb'), content_type=tipo)
+    else:
+        respuesta = StreamingHttpResponse(_guarda(generador(etiquetas), ruta), content_type=tipo)
+    respuesta['Content-Disposition'] = f'{disposicion}; filename="{nombre}.{extension}"'
+    return respuesta
+
+def _guarda(partes, ruta):
+    ''' Transmite las partes y al terminar guarda el archivo completo '''
+    with tempfile.TemporaryFile() as temporal:
+        for parte in partes:
+            temporal.write(parte)
+            yield parte
+        temporal.seek(0)
+        if not default_storage.exists(ruta):
+            default_storage.save(ruta, File(temporal))
@@ -1,8 +1,11 @@
+import re
+
 from django import forms
 from django.core.exceptions import ValidationError
+from django.core.validators import FileExtensionValidator
 from django.utils.translation import gettext as _
 
-from .models import Bodega
+from .models import Bodega, codigo_caja, CAPACIDAD_CAJA
 from usuarios.models import Usuario
      
 
@@ -25,6 +28,10 @@ class GeneraEstructura(forms.Form):
     niveles = forms.IntegerField(required=True, min_value=1)
     posiciones = forms.IntegerField(required=True, min_value=1)
     cajas = forms.IntegerField(required=True, min_value=1)
+    capacidad = forms.IntegerField(required=True, min_value=1, initial=CAPACIDAD_CAJA,
+        help_text=_('Tomos por caja, únicamente para las cajas nuevas'))
+    simular = forms.BooleanField(required=False, label=_('Solo simular'),
+        help_text=_('Muestra cuántos registros se agregarían sin guardarlos'))
 
 
 class GeneraEtiquetas_Form(forms.Form):
@@ -34,16 +41,41 @@ class Bodega_From(forms.ModelForm):
     class Meta:
         model = Bodega
         fields= ['codigo', 'nombre', 'direccion', 'encargado', 'personal', 
-        'correo_egreso', 'correo_traslado']
+        'correo_egreso', 'correo_traslado', 'correo_resumen']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         usuarios = Usuario.objects.filter(is_active=True, groups__name__istartswith='documentos').distinct()
         self.fields['encargado'].queryset = usuarios
         self.fields['personal'].queryset = usuarios
+
+class BodegaNueva_Form(Bodega_From):
+    '''
+        Bodega Create
+        Permite copiar la estructura completa de una bodega existente
+    '''
+    estructura = forms.ModelChoiceField(queryset=Bodega.objects.filter(vigente=True), 
+        required=False, label=_('Copiar estructura de'), 
+        help_text=_('Estantes, niveles, posiciones y cajas de la bodega indicada'))
         
 class CargaCreditos_Form(forms.Form):
-    archivo = forms.FileField(label='Archivo')
+    archivo = forms.FileField(label='Archivo', 
+        help_text=_('Libros de Excel (.xlsx), CSV o un zip con varios archivos'),
+        widget=forms.ClearableFileInput(attrs={'multiple': True}))
+    actualizar = forms.BooleanField(required=False, label=_('Actualizar existentes'),
+        help_text=_('Modifica los datos de los créditos ya registrados que cambiaron'))
+    crear_tomo = forms.BooleanField(required=False, label=_('Crear tomo 1'),
+        help_text=_('Habilita el tomo 1 de los créditos nuevos'))
+
+    def clean_archivo(self):
+        archivos = self.files.getlist(self.add_prefix('archivo'))
+        validador = FileExtensionValidator(['xlsx', 'csv', 'zip'])
+        for archivo in archivos:
+            validador(archivo)
+        if len(archivos) > 1 and any(archivo.name.lower().endswith('.zip') for archivo in archivos):
+            raise ValidationError(_('El zip debe cargarse solo'))
+        self.cleaned_data['archivos'] = archivos
+        return self.cleaned_data['archivo']
 
 
 class IngresoTomo_Form(forms.Form):
@@ -63,13 +95,34 @@ class IngresoTomo_Form(forms.Form):
 
     def clean_caja(self):
         data = self.cleaned_data['caja'].replace(' ', '').split('-')
-        if len(data)!=5 or not (is_integer(data[2]) and is_integer(data[3]) and is_integer(data[4])):
+        if len(data)!=5 or not all(valor.isdigit() for valor in data[2:]):
             raise ValidationError(_('Formato de caja incorrecto'))
-        return data
+        return codigo_caja(*data)
 
 class EgresoTomo_Form(forms.Form):
     tomo = forms.CharField(required=True)
 
+class EnvioTomos_Form(forms.Form):
+    '''
+        Agrega varios tomos a la lista de envío, escritos o escaneados
+        (Credito-Tomo separados por líneas, espacios o comas)
+    '''
+    tomos = forms.CharField(required=True, widget=forms.Textarea(attrs={'rows': 4}),
+        help_text=_('Credito-Tomo, uno por línea'))
+
+    def clean_tomos(self):
+        ''' Devuelve los pares (credito, tomo) válidos y los textos que no lo son '''
+        pares, invalidos = [], []
+        for texto in re.split(r'[\s,;]+', self.cleaned_data['tomos'].strip()):
+            data = texto.split('-')
+            if len(data)==2 and data[0] and data[1].isdigit():
+                pares.append((data[0], int(data[1])))
+            elif texto:
+                invalidos.append(texto)
+        if not pares:
+            raise ValidationError(_('No se ingresó ningún tomo válido'))
+        return pares, invalidos
+
 class TrasladoTomos_Form(forms.Form):
     bodega_envio = forms.ModelChoiceField(queryset=Bodega.objects.filter(vigente=True),
         required=True, help_text=_('Bodega a donde se envían los expedientes'))
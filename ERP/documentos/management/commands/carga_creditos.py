@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from documentos.cargas import EXTENSIONES, es_zip, extrae_zip, carga_varios
+
+
+class Command(BaseCommand):
+    help = 'Carga créditos desde varios libros de Excel, CSV o zip procesándolos en paralelo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archivos', nargs='+', help='Archivos .xlsx, .csv o .zip')
+        parser.add_argument('--actualizar', action='store_true',
+            help='Modifica los datos de los créditos existentes que cambiaron')
+        parser.add_argument('--crear-tomo', action='store_true',
+            help='Habilita el tomo 1 de los créditos nuevos (requiere --usuario)')
+        parser.add_argument('--procesos', type=int, default=None,
+            help='Cantidad máxima de procesos de lectura (por defecto uno por núcleo)')
+        parser.add_argument('--usuario', help='Usuario registrado en el histórico')
+
+    def handle(self, *args, **options):
+        usuario = None
+        if options['usuario']:
+            try:
+                usuario = get_user_model().objects.get(username=options['usuario'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f'No existe el usuario {options["usuario"]}')
+        if options['crear_tomo'] and usuario is None:
+            raise CommandError('--crear-tomo requiere --usuario')
+
+        with tempfile.TemporaryDirectory() as directorio:
+            rutas = []
+            for archivo in options['archivos']:
+                if es_zip(archivo):
+                    rutas += extrae_zip(archivo, directorio)
+                elif archivo.lower().endswith(EXTENSIONES):
+                    rutas.append(os.path.abspath(archivo))
+                else:
+                    raise CommandError(f'Tipo de archivo no soportado: {archivo}')
+
+            reporte = carga_varios(rutas, options['actualizar'], usuario, options['procesos'],
+                options['crear_tomo'])
+
+        for error in reporte['errores']:
+            self.stderr.write(f"{error['fila']}: {error['mensaje']}")
+        self.stdout.write(self.style.SUCCESS(
+            f'Archivos: {len(rutas)} Leídos: {reporte["leidos"]} Insertados: {reporte["insertados"]} '
+            f'Actualizados: {reporte["actualizados"]} Sin cambios: {reporte["sin_cambio"]} '
+            f'Omitidos: {reporte["omitidos"]} '
+            f'Errores: {reporte["cant_errores"]}'))
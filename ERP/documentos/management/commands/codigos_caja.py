@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from documentos.estructura import actualiza_codigos, actualiza_bodegas
+from documentos.models import Bodega, Caja, Tomo
+
+
+class Command(BaseCommand):
+    help = 'Recalcula el código de ubicación y la bodega de cajas y tomos (ejecutar luego de migrar)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bodega', help='Código de la bodega (por defecto todas)')
+
+    def handle(self, *args, **options):
+        cajas, tomos = Caja.objects.all(), Tomo.objects.exclude(caja=None, bodega=None)
+        if options['bodega']:
+            if not Bodega.objects.filter(codigo=options['bodega'].upper()).exists():
+                raise CommandError(f'No existe la bodega {options["bodega"]}')
+            cajas = cajas.filter(posicion__nivel__estante__bodega__codigo=options['bodega'].upper())
+            tomos = tomos.filter(caja__posicion__nivel__estante__bodega__codigo=options['bodega'].upper())
+
+        self.stdout.write(self.style.SUCCESS(f'Cajas actualizadas: {actualiza_codigos(cajas)}'))
+        self.stdout.write(self.style.SUCCESS(f'Tomos actualizados: {actualiza_bodegas(tomos)}'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from documentos.ocupacion import concilia_tomos
+
+
+class Command(BaseCommand):
+    help = 'Verifica por lotes la cantidad de tomos vigentes guardada en cada crédito'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corregir', action='store_true',
+            help='Guarda la cantidad real en los créditos con diferencia')
+        parser.add_argument('--lote', type=int, default=1500, help='Créditos por consulta')
+
+    def handle(self, *args, **options):
+        revisados, diferencias = concilia_tomos(options['corregir'], options['lote'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Créditos revisados: {revisados} Con diferencia: {diferencias}'
+            f'{" (corregidos)" if options["corregir"] and diferencias else ""}'))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from documentos.correos import envia_pendientes
+from documentos.models import Correo
+
+
+class Command(BaseCommand):
+    help = 'Envía los correos de la bandeja de salida'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--una-vez', action='store_true', 
+            help='Envía los correos pendientes y termina')
+        parser.add_argument('--intervalo', type=int, default=10,
+            help='Segundos de espera cuando no hay correos pendientes')
+        parser.add_argument('--lote', type=int, default=50,
+            help='Correos enviados por conexión con el servidor')
+        parser.add_argument('--reintentar', action='store_true',
+            help='Regresa a pendiente los correos que quedaron en error')
+
+    def handle(self, *args, **options):
+        if options['reintentar']:
+            cant = Correo.objects.filter(estado=Correo.ERROR)\
+                .update(estado=Correo.PENDIENTE, intentos=0)
+            self.stdout.write(f'Correos reintentados: {cant}')
+
+        while True:
+            close_old_connections()
+            enviados, fallidos = envia_pendientes(options['lote'])
+            if enviados or fallidos:
+                self.stdout.write(f'Enviados: {enviados} Fallidos: {fallidos}')
+            if enviados < options['lote'] or fallidos:
+                if options['una_vez']:
+                    break
+                time.sleep(options['intervalo'])
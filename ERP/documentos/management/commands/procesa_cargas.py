@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from documentos.cargas import siguiente_carga, procesa_carga
+from documentos.models import CargaCredito
+
+
+class Command(BaseCommand):
+    help = 'Procesa las cargas masivas de créditos pendientes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--una-vez', action='store_true', 
+            help='Procesa las cargas pendientes y termina')
+        parser.add_argument('--intervalo', type=int, default=5,
+            help='Segundos de espera cuando no hay cargas pendientes')
+        parser.add_argument('--reiniciar', action='store_true',
+            help='Regresa a pendiente las cargas que quedaron en proceso (ejecutar con un solo proceso activo)')
+
+    def handle(self, *args, **options):
+        if options['reiniciar']:
+            cant = CargaCredito.objects.filter(estado=CargaCredito.PROCESANDO)\
+                .update(estado=CargaCredito.PENDIENTE, fecha_inicio=None)
+            self.stdout.write(f'Cargas reiniciadas: {cant}')
+
+        while True:
+            close_old_connections()
+            carga = siguiente_carga()
+            if carga is None:
+                if options['una_vez']:
+                    break
+                time.sleep(options['intervalo'])
+                continue
+
+            self.stdout.write(f'Procesando {carga}')
+            try:
+                reporte = procesa_carga(carga)
+                self.stdout.write(self.style.SUCCESS(
+                    f'Leídos: {reporte["leidos"]} Insertados: {reporte["insertados"]} '
+                    f'Actualizados: {reporte["actualizados"]} Sin cambios: {reporte["sin_cambio"]} '
+                    f'Omitidos: {reporte["omitidos"]}'))
+            except Exception as error:
+                self.stderr.write(self.style.ERROR(f'Error en {carga}: {error}'))
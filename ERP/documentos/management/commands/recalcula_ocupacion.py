@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from documentos.models import Bodega
+from documentos.ocupacion import recalcula_ocupacion
+
+
+class Command(BaseCommand):
+    help = 'Reconstruye los contadores de ocupación de cajas, posiciones, niveles, estantes y bodegas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bodega', help='Código de la bodega (por defecto todas)')
+
+    def handle(self, *args, **options):
+        bodega = None
+        if options['bodega']:
+            bodega = Bodega.objects.filter(codigo=options['bodega'].upper()).first()
+            if bodega is None:
+                raise CommandError(f'No existe la bodega {options["bodega"]}')
+
+        reporte = recalcula_ocupacion(bodega)
+        self.stdout.write(self.style.SUCCESS(' '.join(f'{tabla.capitalize()}: {cantidad}' 
+            for tabla, cantidad in reporte.items())))
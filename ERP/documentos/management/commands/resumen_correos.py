@@ -0,0 +1,27 @@
+from datetime import datetime, date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from documentos.correos import encola_resumenes
+
+
+class Command(BaseCommand):
+    help = 'Registra el resumen de traslados y egresos para los encargados de bodegas con resumen diario'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fecha', type=date.fromisoformat, default=None,
+            help='Primer día del periodo (AAAA-MM-DD), ayer por defecto')
+        parser.add_argument('--dias', type=int, default=1,
+            help='Días incluidos en el periodo')
+
+    def handle(self, *args, **options):
+        fecha = options['fecha'] or date.today() - timedelta(days=options['dias'])
+        desde = datetime.combine(fecha, datetime.min.time())
+        if settings.USE_TZ:
+            desde = timezone.make_aware(desde)
+        hasta = desde + timedelta(days=options['dias'])
+
+        cant = encola_resumenes(desde, hasta)
+        self.stdout.write(f'Resúmenes registrados: {cant}')
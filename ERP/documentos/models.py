@@ -2,8 +2,11 @@ import uuid
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.mail import EmailMultiAlternatives
 from django.db import models
+from django.db.models.functions import RowNumber
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from simple_history.models import HistoricalRecords
@@ -18,18 +21,22 @@ class Bodega(models.Model):
     vigente = models.BooleanField(_('Estado'), default=True) # para eliminación lógica
     correo_egreso = models.BooleanField(_('Correo por egreso'), default=True)
     correo_traslado = models.BooleanField(_('Correo por traslado'), default=True)
+    correo_resumen = models.BooleanField(_('Resumen diario'), default=False, 
+        help_text=_('El encargado recibe un resumen de traslados y egresos en lugar de un correo por traslado'))
     encargado = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, 
         help_text=_('Usuarios en grupos que inicien con "Expedientes"'), 
         verbose_name=_('Encargado'))
     personal = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='bodega_personal', 
         help_text=_('Usuarios en grupos que inicien con "Expedientes"'), 
         verbose_name=_('Personal'))
-    history = HistoricalRecords(user_model=settings.AUTH_USER_MODEL)
+    ocupacion = models.PositiveIntegerField(_('Ocupación'), default=0, editable=False) # tomos en sus cajas, ver ocupacion.py
+    history = HistoricalRecords(excluded_fields=['ocupacion'], user_model=settings.AUTH_USER_MODEL)
     
     class Meta:
         permissions = [
             ("genera_estructura", "Permite generar estructura de la bodega"),
             ("view_estructura", "Permite visualizar la estructura de la bodega"),
+            ("label_bodega", "Permite la impresión de todas las etiquetas de la bodega"),
         ]
 
     def __str__(self):
@@ -40,6 +47,12 @@ class Bodega(models.Model):
         if qs.exists():
             raise ValidationError(_('Código o nombre repetido.'))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        bodega = super().from_db(db, field_names, values)
+        bodega._codigo_original = bodega.__dict__.get('codigo') # ver signals.bodega_modificada
+        return bodega
+
     def save(self, *args, **kwargs):
         self.codigo = self.codigo.upper()
         self.nombre = self.nombre.upper()
@@ -66,6 +79,9 @@ class Bodega(models.Model):
     def delete_url(self):
         return reverse('documentos:bodega_delete', kwargs={'pk': self.id})
 
+    def labels_url(self):
+        return reverse('documentos:bodega_labels', kwargs={'pk': self.id})
+
     def get_estado(self):
         return _('Vigente') if self.vigente else _('No Vigente')
 
@@ -78,9 +94,10 @@ class Bodega(models.Model):
 
 class Estante(models.Model):
     id      = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    codigo  = models.CharField(_('Código'), max_length=2, db_index=True, help_text=_('Código máximo de 2 caracteres'))
+    codigo  = models.CharField(_('Código'), max_length=3, db_index=True, help_text=_('Código máximo de 3 caracteres'))
     vigente = models.BooleanField(_('Estado'), default=True) # para eliminación lógica
     bodega  = models.ForeignKey(Bodega, on_delete=models.PROTECT, related_name='estante_bodega', verbose_name=_('Bodega'))
+    ocupacion = models.PositiveIntegerField(_('Ocupación'), default=0, editable=False) # tomos en sus cajas, ver ocupacion.py
     
     class Meta:
         constraints = [
@@ -131,6 +148,7 @@ class Nivel(models.Model):
     numero  = models.PositiveSmallIntegerField(_('Peldaño'), help_text=_('Número del nivel a registrar'))
     vigente = models.BooleanField(_('Estado'), default=True) # para eliminación lógica
     estante = models.ForeignKey(Estante, on_delete=models.PROTECT, related_name='nivel_estante', verbose_name=_('Estante'))
+    ocupacion = models.PositiveIntegerField(_('Ocupación'), default=0, editable=False) # tomos en sus cajas, ver ocupacion.py
     
     class Meta:
         constraints = [
@@ -167,6 +185,7 @@ class Posicion(models.Model):
     numero = models.PositiveSmallIntegerField(_('Posición'))
     vigente = models.BooleanField(_('Estado'), default=True) # para eliminación lógica
     nivel = models.ForeignKey(Nivel, on_delete=models.PROTECT, related_name='posicion_nivel', verbose_name=_('Nivel'))
+    ocupacion = models.PositiveIntegerField(_('Ocupación'), default=0, editable=False) # tomos en sus cajas, ver ocupacion.py
     
     class Meta:
         constraints = [
@@ -198,32 +217,62 @@ class Posicion(models.Model):
         return reverse('documentos:posicion_labels', kwargs={'pk': self.id})
 
 
+def codigo_caja(bodega, estante, nivel, posicion, numero):
+    ''' Código de ubicación de la caja: Bodega-Estante-Nivel-Posición-Caja '''
+    return f"{bodega}-{estante}-{int(nivel):02d}-{int(posicion):02d}-{int(numero):02d}".upper()
+
+CAPACIDAD_CAJA = 10
+
 class Caja(models.Model):
     id      = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     numero = models.PositiveSmallIntegerField(_('Numero'))
     vigente = models.BooleanField(_('Estado'), default=True) # para eliminación lógica
     posicion = models.ForeignKey(Posicion, on_delete=models.PROTECT, related_name='caja_posicion', verbose_name=_('Posición'))
-    history = HistoricalRecords(excluded_fields=['numero', 'posicion'], user_model=settings.AUTH_USER_MODEL)
+    codigo  = models.CharField(_('Código'), max_length=20, unique=True, null=True, editable=False) # ubicación completa, ver codigo_caja
+    bodega  = models.ForeignKey(Bodega, on_delete=models.PROTECT, null=True, editable=False, related_name='caja_bodega') # copia de posicion.nivel.estante.bodega
+    ocupacion = models.PositiveIntegerField(_('Ocupación'), default=0, editable=False) # tomos en la caja, ver ocupacion.py
+    capacidad = models.PositiveSmallIntegerField(_('Capacidad'), default=CAPACIDAD_CAJA, 
+        help_text=_('Cantidad máxima de tomos'))
+    history = HistoricalRecords(excluded_fields=['numero', 'posicion', 'codigo', 'bodega', 'ocupacion'], user_model=settings.AUTH_USER_MODEL)
     
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['posicion', 'numero'], name='unq_posicion_numero'),
         ]
+        indexes = [
+            models.Index(fields=['bodega', 'vigente', 'ocupacion'], name='idx_caja_disponible'),
+        ]
         permissions = [
             ("label_caja", "Permite la impresión de la etiqueta de la caja"),
         ]
 
     def __str__(self):
-        return f"{self.posicion}-{self.numero:02d}"
+        return self.codigo or f"{self.posicion}-{self.numero:02d}"
 
     def validate_fields(self, exclude=None):
         qs = Caja.objects.filter(numero=self.numero, posicion=self.posicion).exclude(pk=self.pk)
         if qs.exists():
             raise ValidationError(_('Posicion y caja repetida.'))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        caja = super().from_db(db, field_names, values)
+        caja._ubicacion = (caja.__dict__.get('posicion_id'), caja.__dict__.get('numero'))
+        return caja
+
     def save(self, *args, **kwargs):
-        self.validate_fields()
+        '''
+            El código y la bodega se calculan, con una consulta, solo para las
+            cajas nuevas o si cambió la posición o el número
+        '''
+        if self._state.adding or getattr(self, '_ubicacion', None) != (self.posicion_id, self.numero):
+            self.validate_fields()
+            bodega, *ubicacion = Posicion.objects.filter(pk=self.posicion_id).values_list(
+                'nivel__estante__bodega_id', 'nivel__estante__bodega__codigo', 'nivel__estante__codigo', 
+                'nivel__numero', 'numero').get()
+            self.codigo, self.bodega_id = codigo_caja(*ubicacion, self.numero), bodega
         super().save(*args, **kwargs)
+        self._ubicacion = (self.posicion_id, self.numero)
 
     def delete(self):
         self.vigente = not self.vigente
@@ -258,7 +307,7 @@ class Caja(models.Model):
 
     def get_tomos(self):
         return Tomo.objects.filter(caja=self).order_by('-fecha_modificacion')\
-            .prefetch_related('credito')
+            .annotate(posicion_caja=posicion_caja()).prefetch_related('credito')
 
 
 class Cliente(models.Model):
@@ -307,8 +356,10 @@ class Credito(models.Model):
     moneda  = models.ForeignKey(Moneda, on_delete=models.PROTECT, related_name='credito_moneda')
     oficina = models.ForeignKey(Oficina, on_delete=models.PROTECT, related_name='credito_oficina')
     producto= models.ForeignKey(Producto, on_delete=models.PROTECT, related_name='credito_producto')
+    huella  = models.CharField(max_length=32, blank=True, default='', editable=False)
+    tomos_vigentes = models.PositiveIntegerField(_('Cant. de Tomos'), default=0, editable=False) # se mantiene al habilitar/inhabilitar tomos
     history = HistoricalRecords(excluded_fields=['numero', 'monto', 'fecha_concesion', 
-        'fecha_ingreso', 'cliente', 'moneda', 'oficina', 'producto'],
+        'fecha_ingreso', 'cliente', 'moneda', 'oficina', 'producto', 'huella', 'tomos_vigentes'],
         user_model=settings.AUTH_USER_MODEL)
     
     class Meta:
@@ -330,7 +381,11 @@ class Credito(models.Model):
         return reverse('documentos:credito_labels', kwargs={'pk': self.id})
 
     def cant_tomos(self):
-        return Tomo.objects.filter(credito=self, vigente=True).count()
+        return self.tomos_vigentes
+
+    def suma_tomos(self, cantidad):
+        ''' Ajusta tomos_vigentes en la base de datos sin pisar cambios concurrentes '''
+        Credito.objects.filter(pk=self.pk).update(tomos_vigentes=models.F('tomos_vigentes')+cantidad)
 
     def esta_escaneado(self):
         return _('Si') if self.escaneado else _('No')
@@ -344,10 +399,12 @@ class Tomo(models.Model):
     comentario = models.TextField()
     credito = models.ForeignKey(Credito, on_delete=models.PROTECT, related_name='tomo_credito')
     caja    = models.ForeignKey(Caja, on_delete=models.PROTECT, null=True, related_name='tomo_caja')
+    bodega  = models.ForeignKey(Bodega, on_delete=models.PROTECT, null=True, editable=False, related_name='tomo_bodega') # copia de caja.bodega
     usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Usuario'), related_name='tomo_usuario')
+    movimiento = models.ForeignKey('Movimiento', on_delete=models.PROTECT, null=True, editable=False, related_name='tomo_movimiento') # último traslado o egreso
     history = HistoricalRecords(
         history_id_field = models.BigAutoField(),
-        excluded_fields=['numero', 'credito', 'usuario'],
+        excluded_fields=['numero', 'credito', 'usuario', 'bodega'],
         user_model=settings.AUTH_USER_MODEL,
         )
 
@@ -365,6 +422,10 @@ class Tomo(models.Model):
     def __str__(self):
         return "{}-{}".format(self.credito.numero, self.numero)
 
+    def save(self, *args, **kwargs):
+        self.bodega_id = self.caja.bodega_id if self.caja_id else None
+        super().save(*args, **kwargs)
+
     def view_credito(self):
         return reverse('documentos:credito_view', kwargs={'pk': self.credito.id})
 
@@ -378,5 +439,224 @@ class Tomo(models.Model):
         return reverse('documentos:tomo_labels', kwargs={'pk': self.id})
 
     def get_posicion(self):
+        ''' Usa la anotación posicion_caja cuando la consulta la incluye (ver posicion_caja) '''
+        if hasattr(self, 'posicion_caja'):
+            return self.posicion_caja
         return Caja.objects.filter(id=self.caja.id, tomo_caja__fecha_modificacion__gte=self.fecha_modificacion).count()
 
+def posicion_caja():
+    '''
+        Posición del tomo dentro de su caja (1 el último modificado) para
+        annotate. La ventana se calcula sobre las filas de la consulta, por lo
+        que deben incluirse todos los tomos de las cajas (ver asigna_posiciones).
+    '''
+    return models.Window(RowNumber(), partition_by=[models.F('caja')], 
+        order_by=models.F('fecha_modificacion').desc())
+
+def asigna_posiciones(tomos):
+    '''
+        Asigna posicion_caja a los tomos (ya consultados) con una sola
+        consulta sobre todos los tomos de sus cajas
+    '''
+    cajas = {tomo.caja_id for tomo in tomos if tomo.caja_id}
+    posiciones = dict(Tomo.objects.filter(caja__in=cajas).annotate(posicion_caja=posicion_caja())\
+        .values_list('id', 'posicion_caja')) if cajas else {}
+    for tomo in tomos:
+        if tomo.caja_id:
+            tomo.posicion_caja = posiciones[tomo.id]
+    return tomos
+
+
+class ImpresionCaja(models.Model):
+    ''' Registro de la primera impresión de la etiqueta de la caja '''
+    caja    = models.OneToOneField(Caja, on_delete=models.CASCADE, primary_key=True, related_name='impresion_caja')
+    fecha   = models.DateTimeField(_('Fecha'), auto_now_add=True)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, 
+        verbose_name=_('Usuario'), related_name='impresion_caja_usuario')
+
+class ImpresionTomo(models.Model):
+    ''' Registro de la primera impresión de la etiqueta del tomo '''
+    tomo    = models.OneToOneField(Tomo, on_delete=models.CASCADE, primary_key=True, related_name='impresion_tomo')
+    fecha   = models.DateTimeField(_('Fecha'), auto_now_add=True)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, 
+        verbose_name=_('Usuario'), related_name='impresion_tomo_usuario')
+
+
+class EnvioTomo(models.Model):
+    ''' Tomos que el usuario seleccionó para trasladar o egresar (ver envios.py) '''
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, 
+        verbose_name=_('Usuario'), related_name='envio_usuario')
+    tomo    = models.ForeignKey(Tomo, on_delete=models.CASCADE, related_name='envio_tomo')
+    fecha   = models.DateTimeField(_('Fecha'), auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['usuario', 'tomo'], name='unq_usuario_tomo'),
+        ]
+
+
+class Movimiento(models.Model):
+    '''
+        Traslado o egreso de tomos (ver envios.py). Los datos de la salida se
+        guardan una vez por bodega de origen y los tomos, y su historial, lo
+        referencian.
+    '''
+    TRASLADO, EGRESO = 'T', 'E'
+    TIPOS = [
+        (TRASLADO, _('Traslado')),
+        (EGRESO, _('Egreso')),
+    ]
+
+    id      = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    tipo    = models.CharField(_('Tipo'), max_length=1, choices=TIPOS)
+    fecha   = models.DateTimeField(_('Fecha'), auto_now_add=True)
+    bodega_origen = models.ForeignKey(Bodega, on_delete=models.PROTECT, null=True, 
+        verbose_name=_('Bodega origen'), related_name='movimiento_origen')
+    bodega_destino = models.ForeignKey(Bodega, on_delete=models.PROTECT, null=True, 
+        verbose_name=_('Bodega destino'), related_name='movimiento_destino')
+    codigo  = models.PositiveIntegerField(_('Código de colaborador'), null=True)
+    nombre  = models.CharField(_('Nombre'), max_length=60, blank=True)
+    extension = models.CharField(_('Extensión'), max_length=6, blank=True)
+    correo  = models.EmailField(_('Correo'), max_length=120, blank=True)
+    gerencia = models.CharField(_('Gerencia'), max_length=60, blank=True)
+    comentario = models.CharField(_('Comentario'), max_length=254, blank=True)
+    tomos   = models.PositiveIntegerField(_('Tomos'), default=0)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, 
+        verbose_name=_('Usuario'), related_name='movimiento_usuario')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['codigo', 'fecha']),
+            models.Index(fields=['tipo', 'fecha']),
+        ]
+
+    def __str__(self):
+        if self.tipo == self.TRASLADO:
+            return f'Traslado a {self.bodega_destino} ({self.fecha:%d/%m/%Y %H:%M})'
+        return f'Egreso a {self.codigo} - {self.nombre} ({self.fecha:%d/%m/%Y %H:%M})'
+
+    def detalle(self):
+        ''' Datos de la salida como se escribían antes en el comentario de cada tomo '''
+        if self.tipo == self.TRASLADO:
+            return f'Traslado a {self.bodega_destino}\n{self.comentario}'
+        detalle = f'Fecha: \t\t{self.fecha:%d-%m-%Y}\n'
+        detalle += f'Codigo: \t{self.codigo}\n'
+        detalle += f'Nombre: \t{self.nombre}\n'
+        detalle += f'Extension: \t{self.extension}\n'
+        detalle += f'Correo: \t{self.correo}\n'
+        detalle += f'Gerencia: \t{self.gerencia}\n'
+        detalle += f'Comentario: \t{self.comentario}'
+        return detalle
+
+
+class Correo(models.Model):
+    '''
+        Bandeja de salida: los correos se registran en la transacción de la
+        operación que los genera y el comando "envia_correos" los envía
+        (ver correos.py)
+    '''
+    PENDIENTE, ENVIADO, ERROR = 'P', 'E', 'X'
+    ESTADOS = [
+        (PENDIENTE, _('Pendiente')),
+        (ENVIADO, _('Enviado')),
+        (ERROR, _('Error')),
+    ]
+
+    id      = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    asunto  = models.CharField(_('Asunto'), max_length=150)
+    remitente = models.EmailField(_('Remitente'), blank=True)
+    destinatarios = models.JSONField(_('Destinatarios'), default=list)
+    contenido = models.TextField(_('Contenido'))
+    estado  = models.CharField(_('Estado'), max_length=1, choices=ESTADOS, default=PENDIENTE)
+    intentos = models.PositiveSmallIntegerField(_('Intentos'), default=0)
+    siguiente_intento = models.DateTimeField(_('Siguiente intento'), default=timezone.now)
+    fecha_creacion = models.DateTimeField(_('Fecha'), auto_now_add=True)
+    fecha_envio = models.DateTimeField(_('Envío'), null=True, blank=True)
+    error   = models.TextField(_('Error'), blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['estado', 'siguiente_intento'])
+        ]
+
+    def __str__(self):
+        return f"{self.asunto} ({self.fecha_creacion:%d/%m/%Y %H:%M})"
+
+    def mensaje(self, conexion=None):
+        mail = EmailMultiAlternatives(
+            subject=self.asunto,
+            body='',
+            from_email=self.remitente or None,
+            to=self.destinatarios,
+            cc=[],
+            connection=conexion,
+            )
+        mail.attach_alternative(self.contenido, 'text/html')
+        return mail
+
+
+class CargaCredito(models.Model):
+    '''
+        Carga masiva de créditos procesada en segundo plano por el comando
+        "procesa_cargas"
+    '''
+    PENDIENTE, PROCESANDO, TERMINADO, ERROR = 'P', 'R', 'T', 'E'
+    ESTADOS = [
+        (PENDIENTE, _('Pendiente')),
+        (PROCESANDO, _('Procesando')),
+        (TERMINADO, _('Terminado')),
+        (ERROR, _('Error')),
+    ]
+
+    id      = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    archivo = models.FileField(_('Archivo'), upload_to='documentos/cargas/')
+    estado  = models.CharField(_('Estado'), max_length=1, choices=ESTADOS, default=PENDIENTE)
+    actualizar = models.BooleanField(_('Actualizar existentes'), default=False,
+        help_text=_('Modifica los datos de los créditos ya registrados que cambiaron'))
+    crear_tomo = models.BooleanField(_('Crear tomo 1'), default=False,
+        help_text=_('Habilita el tomo 1 de los créditos nuevos'))
+    fecha_creacion = models.DateTimeField(_('Fecha'), auto_now_add=True)
+    fecha_inicio = models.DateTimeField(_('Inicio'), null=True, blank=True)
+    fecha_fin = models.DateTimeField(_('Fin'), null=True, blank=True)
+    leidos  = models.PositiveIntegerField(_('Filas leídas'), default=0)
+    insertados = models.PositiveIntegerField(_('Créditos insertados'), default=0)
+    actualizados = models.PositiveIntegerField(_('Créditos actualizados'), default=0)
+    sin_cambio = models.PositiveIntegerField(_('Créditos sin cambios'), default=0)
+    omitidos = models.PositiveIntegerField(_('Filas omitidas'), default=0)
+    reporte = models.JSONField(_('Reporte'), default=dict, blank=True)
+    mensaje = models.TextField(_('Mensaje'), blank=True)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, 
+        verbose_name=_('Usuario'), related_name='carga_usuario')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['estado', 'fecha_creacion'])
+        ]
+
+    def __str__(self):
+        return f"{self.archivo.name.split('/')[-1]} ({self.fecha_creacion:%d/%m/%Y %H:%M})"
+
+    def list_url(self=None):
+        return reverse('documentos:carga_list')
+
+    def view_url(self):
+        return reverse('documentos:carga_view', kwargs={'pk': self.id})
+
+    def estado_url(self):
+        return reverse('documentos:carga_estado', kwargs={'pk': self.id})
+
+    def en_proceso(self):
+        return self.estado in (self.PENDIENTE, self.PROCESANDO)
+
+    def progreso(self):
+        return {
+            'estado': self.estado,
+            'estado_display': self.get_estado_display(),
+            'leidos': self.leidos,
+            'insertados': self.insertados,
+            'actualizados': self.actualizados,
+            'sin_cambio': self.sin_cambio,
+            'omitidos': self.omitidos,
+            'errores': self.reporte.get('cant_errores', 0),
+            'mensaje': self.mensaje,
+        }
@@ -0,0 +1,131 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Count, Sum, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .estructura import invalida_estructura
+from .models import Bodega, Estante, Nivel, Posicion, Caja, Tomo, Credito
+
+
+##########################################################################
+# Contadores
+##########################################################################
+NIVELES = (
+    (Caja, 'id'),
+    (Posicion, 'posicion_id'),
+    (Nivel, 'posicion__nivel_id'),
+    (Estante, 'posicion__nivel__estante_id'),
+    (Bodega, 'bodega_id'),
+)
+
+def ajusta_ocupacion(variaciones):
+    '''
+        Suma a la ocupación de cada caja la variación indicada ({caja_id:
+        cantidad}, negativa en las salidas) y la acumula en su posición,
+        nivel, estante y bodega. Se hace una consulta para ubicar las cajas y
+        un UPDATE con F() por tabla y por cantidad distinta, en una
+        transacción.
+    '''
+    variaciones = {caja: cantidad for caja, cantidad in variaciones.items() if cantidad}
+    if not variaciones:
+        return
+    ubicaciones = Caja.objects.filter(id__in=variaciones)\
+        .values_list(*(campo for modelo, campo in NIVELES))
+
+    with transaction.atomic():
+        for indice, (modelo, campo) in enumerate(NIVELES):
+            totales = defaultdict(int)
+            for ubicacion in ubicaciones:
+                totales[ubicacion[indice]] += variaciones[ubicacion[0]]
+            llaves = defaultdict(list)
+            for llave, cantidad in totales.items():
+                if cantidad:
+                    llaves[cantidad].append(llave)
+            for cantidad, lista in llaves.items():
+                modelo.objects.filter(id__in=lista).update(ocupacion=F('ocupacion')+cantidad)
+    invalida_estructura(*{ubicacion[-1] for ubicacion in ubicaciones})
+
+
+##########################################################################
+# Conciliación
+##########################################################################
+def recalcula_ocupacion(bodega=None):
+    '''
+        Reconstruye los contadores a partir de los tomos: un UPDATE por tabla
+        con subconsulta agregada, de la caja hacia la bodega. Con "bodega" se
+        limita a su estructura. Devuelve la cantidad de registros por tabla.
+    '''
+    def total(modelo, padre, agregado):
+        return Coalesce(Subquery(modelo.objects.filter(**{padre: OuterRef('pk')}).order_by()\
+            .values(padre).annotate(total=agregado).values('total')), Value(0))
+
+    def filtro(campo):
+        return {campo: bodega.pk} if bodega else {}
+
+    reporte = {}
+    with transaction.atomic():
+        reporte['cajas'] = Caja.objects.filter(**filtro('bodega'))\
+            .update(ocupacion=total(Tomo, 'caja', Count('id')))
+        reporte['posiciones'] = Posicion.objects.filter(**filtro('nivel__estante__bodega'))\
+            .update(ocupacion=total(Caja, 'posicion', Sum('ocupacion')))
+        reporte['niveles'] = Nivel.objects.filter(**filtro('estante__bodega'))\
+            .update(ocupacion=total(Posicion, 'nivel', Sum('ocupacion')))
+        reporte['estantes'] = Estante.objects.filter(**filtro('bodega'))\
+            .update(ocupacion=total(Nivel, 'estante', Sum('ocupacion')))
+        reporte['bodegas'] = Bodega.objects.filter(**filtro('pk'))\
+            .update(ocupacion=total(Estante, 'bodega', Sum('ocupacion')))
+    invalida_estructura(*(Bodega.objects.filter(**filtro('pk')).values_list('id', flat=True)))
+    return reporte
+
+
+##########################################################################
+# Sugerencia de caja
+##########################################################################
+def sugiere_caja(tomo, bodegas):
+    '''
+        Caja vigente con espacio libre para el tomo dentro de las bodegas
+        indicadas (llaves): la más vacía del nivel donde están los otros
+        tomos del crédito o, si no hay, la más vacía de las bodegas. Usa el
+        índice (bodega, vigente, ocupacion), sin contar tomos.
+    '''
+    bodegas = list(Bodega.objects.filter(id__in=bodegas, vigente=True).values_list('id', flat=True))
+    disponibles = Caja.objects.filter(bodega__in=bodegas, vigente=True, ocupacion__lt=F('capacidad'))\
+        .order_by('ocupacion')
+    niveles = set(Tomo.objects.filter(credito_id=tomo.credito_id, bodega__in=bodegas)\
+        .exclude(pk=tomo.pk).values_list('caja__posicion__nivel_id', flat=True))
+
+    caja = disponibles.filter(posicion__nivel__in=niveles).first() if niveles else None
+    return caja or disponibles.first()
+
+
+##########################################################################
+# Tomos vigentes por crédito
+##########################################################################
+def concilia_tomos(corregir=False, lote=1500):
+    '''
+        Compara Credito.tomos_vigentes con el conteo real por lotes de
+        créditos (una consulta agregada por lote) y, con corregir, guarda el
+        valor real. Devuelve la cantidad de créditos revisados y con diferencia.
+    '''
+    revisados, diferencias = 0, 0
+    creditos = Credito.objects.order_by('id').values_list('id', 'tomos_vigentes')
+    bloque = []
+    for registro in creditos.iterator(chunk_size=lote):
+        bloque.append(registro)
+        if len(bloque) == lote:
+            diferencias += _concilia_bloque(bloque, corregir)
+            revisados, bloque = revisados + len(bloque), []
+    if bloque:
+        diferencias += _concilia_bloque(bloque, corregir)
+        revisados += len(bloque)
+    return revisados, diferencias
+
+def _concilia_bloque(bloque, corregir):
+    reales = dict(Tomo.objects.filter(credito_id__in=[llave for llave, actual in bloque], vigente=True)\
+        .order_by().values_list('credito').annotate(Count('id')))
+    cambios = [Credito(id=llave, tomos_vigentes=reales.get(llave, 0)) for llave, actual in bloque
+        if reales.get(llave, 0) != actual]
+    if corregir:
+        Credito.objects.bulk_update(cambios, ['tomos_vigentes'], batch_size=1500)
+    return len(cambios)
@@ -0,0 +1,32 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .acceso import invalida_accesos
+from .estructura import invalida_estructura, actualiza_codigos
+from .models import Bodega, Caja
+
+
+@receiver(post_save, sender=Bodega)
+@receiver(post_delete, sender=Bodega)
+def bodega_modificada(sender, instance, **kwargs):
+    '''
+        El encargado o el código pudieron cambiar. Si cambió el código se
+        recalcula Caja.codigo de sus cajas, sin importar desde dónde se guarde.
+    '''
+    invalida_accesos()
+    invalida_estructura(instance.id)
+    if kwargs['signal'] is post_delete:
+        return
+    if not kwargs['created'] and getattr(instance, '_codigo_original', None) != instance.codigo:
+        actualiza_codigos(Caja.objects.filter(bodega=instance))
+    instance._codigo_original = instance.codigo
+
+@receiver(post_save, sender=Caja)
+def caja_modificada(sender, instance, **kwargs):
+    ''' Habilitar o inhabilitar la caja (Caja.delete) '''
+    invalida_estructura(instance.bodega_id)
+
+@receiver(m2m_changed, sender=Bodega.personal.through)
+def personal_modificado(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalida_accesos()
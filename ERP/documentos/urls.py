@@ -11,6 +11,7 @@ urlpatterns = [
     path('bodegas/create/', views.Bodega_CreateView.as_view(), name='bodega_create'),
     path('bodegas/update/<uuid:pk>', views.Bodega_UpdateView.as_view(), name='bodega_update'),
     path('bodegas/delete/<uuid:pk>', views.Bodega_DeleteView.as_view(), name='bodega_delete'),
+    path('bodegas/etiquetas/<uuid:pk>/', views.Bodega_Etiqueta.as_view(), name='bodega_labels'),
 
     path('estantes/<uuid:pk>/', views.Estante_DetailView.as_view(), name='estante_view'),
     path('estantes/etiquetas/<uuid:pk>/', views.Estante_Etiqueta.as_view(), name='estante_labels'),
@@ -27,6 +28,9 @@ urlpatterns = [
     path('cajas/etiquetas/<uuid:pk>/', views.Caja_Etiqueta.as_view(), name='caja_labels'),
 
     path('creditos/carga/', views.CargaMasiva_Form.as_view(), name='carga'),
+    path('creditos/cargas/', views.CargaCredito_ListView.as_view(), name='carga_list'),
+    path('creditos/cargas/<uuid:pk>/', views.CargaCredito_DetailView.as_view(), name='carga_view'),
+    path('creditos/cargas/<uuid:pk>/estado/', views.CargaCredito_Estado.as_view(), name='carga_estado'),
     path('creditos/buscar/', views.buscar_credito, name='credito_search'),
     path('creditos/<uuid:pk>/', views.Credito_DetailView.as_view(), name='credito_view'),
     path('creditos/etiquetas/<uuid:pk>/', views.Credito_Etiqueta.as_view(), name='credito_labels'),
@@ -35,6 +39,7 @@ urlpatterns = [
     path('tomos/opera/<uuid:pk>', views.operaciones_tomo, name='opera_tomo'), #agrega/habilita o deshabilita tomo
     path('tomos/ingreso/', views.Tomo_Ingreso.as_view(), name='ingreso_tomo'), 
     path('tomos/envio/', views.Tomo_Template.as_view(), name='envio_tomo'), # visualiza el ilstado de tomos a procesar
+    path('tomos/envio/lista/', views.lista_envio, name='lista_envio'), # agrega o quita tomos de la lista
     path('tomos/trasladar/', views.salida_tomo, name='salida_tomo'), # proceso las salidas
     path('tomos/etiquetas/<uuid:pk>/', views.Tomo_Etiqueta.as_view(), name='tomo_labels'),
 
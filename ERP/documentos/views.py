@@ -1,26 +1,30 @@
-import openpyxl
-import threading
-
-from datetime import datetime
-from string import ascii_uppercase
-from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+from functools import partial
 
 from django.contrib import messages
-from django.core.mail import EmailMultiAlternatives
-from django.db.models import Q, Max
-from django.db.models.functions import Length
+from django.contrib.auth.decorators import permission_required
+from django.db import transaction
+from django.db.models import Max
+from django.http import JsonResponse
 from django.shortcuts import render, redirect
-from django.template.loader import get_template
 from django.utils.translation import gettext as _
 from django.views.generic import TemplateView
 from django.views.generic.edit import FormMixin
 from django.urls import reverse_lazy
 
-from .models import (Bodega, Estante, Nivel, Posicion, Caja, Cliente, Moneda,
-    Producto, Oficina, Credito, Tomo)
+from .models import (Bodega, Estante, Nivel, Posicion, Caja, Credito, Tomo, CargaCredito, 
+    ImpresionCaja, ImpresionTomo, codigo_caja, asigna_posiciones, EnvioTomo, Movimiento)
+from .acceso import AccesoBodega_Mixin, bodegas_personal, bodegas_usuario
+from .cargas import empaqueta
+from .envios import tomos_envio, agrega_envio, quita_envio, salida_envio
+from .correos import encola_correo
+from .ocupacion import ajusta_ocupacion, sugiere_caja
+from .etiquetas import (respuesta_etiquetas, etiquetas_caja, etiquetas_tomo, pendientes, 
+    registra_impresion)
+from .estructura import (genera_estructura, clona_estructura, grilla_bodega, 
+    grilla_estante, version_estructura)
 from .forms import (Busqueda, GeneraEstructura, GeneraEtiquetas_Form, 
-    CargaCreditos_Form, IngresoTomo_Form, EgresoTomo_Form, Bodega_From, 
-    TrasladoTomos_Form, SalidaTomos_Form)
+    CargaCreditos_Form, IngresoTomo_Form, EgresoTomo_Form, Bodega_From, BodegaNueva_Form, 
+    TrasladoTomos_Form, SalidaTomos_Form, EnvioTomos_Form)
 from usuarios.views_base import (ListView_Login, DetailView_Login, TemplateView_Login, 
     CreateView_Login, UpdateView_Login, DeleteView_Login, FormView_Login)
 
@@ -32,7 +36,7 @@ class Inicio_Template(TemplateView):
     }
 
 
-class Bodega_ListView(ListView_Login):
+class Bodega_ListView(AccesoBodega_Mixin, ListView_Login):
     permission_required = 'documentos.view_bodega'
     model = Bodega
     paginate_by = 15
@@ -64,16 +68,7 @@ class Bodega_ListView(ListView_Login):
             context['form'] = Busqueda()
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:    
-            return queryset.filter(
-                Q(personal=self.request.user)
-                |Q(encargado=self.request.user)).distinct()
-
-class Bodega_DetailView(FormMixin, DetailView_Login):
+class Bodega_DetailView(FormMixin, AccesoBodega_Mixin, DetailView_Login):
     permission_required = 'documentos.view_bodega'
     model = Bodega
     form_class = GeneraEstructura
@@ -94,27 +89,17 @@ class Bodega_DetailView(FormMixin, DetailView_Login):
             'etiqueta': _('Opciones'),
             'editar': _('Editar'),
             'cajas_inhabilitadas': _('Cajas Inhabilitadas'),
+            'etiquetas': _('Etiquetas'),
+            'pendientes': _('Pendientes'),
         }
-        queryset = Nivel.objects.filter(estante__bodega=self.object)\
-            .order_by(Length('estante__codigo'), 'estante__codigo', 'numero')\
-            .prefetch_related('estante', 'estante__bodega')
         context['estructura']={
             'tooltip_head': _('Estante'),
             'tooltip_body': _('Nivel'),
-            'estructura': queryset,
-            'max_columnas': queryset.aggregate(Max('numero'))['numero__max'],
+            'grilla': partial(grilla_bodega, self.object), # se consulta únicamente si no está en caché
+            'version': version_estructura(self.object.id),
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:    
-            return queryset.filter(
-                Q(personal=self.request.user)
-                |Q(encargado=self.request.user)).distinct()
-
     def get_success_url(self, *args, **kwargs):
         return self.object.view_url()
 
@@ -128,73 +113,22 @@ class Bodega_DetailView(FormMixin, DetailView_Login):
                 return self.form_invalid(form)
     
     def form_valid(self, form, *args, **kwargs):
-        e = form.cleaned_data['estantes']
-        n = form.cleaned_data['niveles']
-        p = form.cleaned_data['posiciones']
-        c = form.cleaned_data['cajas']
-        self._genera_estructura(e, n, p, c)
+        datos = form.cleaned_data
+        agregados = genera_estructura(self.object, datos['estantes'], datos['niveles'], 
+            datos['posiciones'], datos['cajas'], usuario=self.request.user, simular=datos['simular'],
+            capacidad=datos['capacidad'])
+        detalle = ', '.join(f'{nivel}: {cantidad}' for nivel, cantidad in agregados.items())
+        if datos['simular']:
+            messages.info(self.request, _('Se agregarían ')+detalle)
+        else:
+            messages.success(self.request, _('Registros agregados ')+detalle)
 
         return super().form_valid(form)
 
-    def _genera_estructura(self, pEstantes, pNiveles, pPosiciones, pCajas):
-        self._genera_estructura_estantes(pEstantes)
-        self._genera_estructura_niveles(pNiveles)
-        self._genera_estructura_posiciones(pPosiciones)
-        self._genera_estructura_cajas(pCajas)
-    
-    def _genera_estructura_cajas(self, pCaja):
-        inserts = []
-        cajas = Caja.objects.filter(posicion__nivel__estante__bodega=self.object)
-        for posicion in Posicion.objects.filter(nivel__estante__bodega=self.object, vigente=True):
-            for i in range(1, pCaja+1):
-                if not cajas.filter(numero=i, posicion=posicion):
-                    inserts.append(Caja(numero=i, posicion=posicion))
-
-        bulk_create_with_history(inserts, Caja, batch_size=1500)
-
-    def _genera_estructura_posiciones(self, pPosicion):
-        inserts = []
-        posiciones = Posicion.objects.filter(nivel__estante__bodega=self.object)
-        for nivel in Nivel.objects.filter(estante__bodega=self.object, vigente=True):
-            for i in range(1, pPosicion+1):
-                if not posiciones.filter(numero=i, nivel=nivel):
-                    inserts.append(Posicion(numero=i, nivel=nivel))
-
-        Posicion.objects.bulk_create(inserts)
-
-    def _genera_estructura_niveles(self, pNiveles):
-        inserts = []
-        niveles = Nivel.objects.filter(estante__bodega=self.object)
-        for estante in Estante.objects.filter(bodega=self.object, vigente=True):
-            for i in range(1, pNiveles+1):
-                if not niveles.filter(numero=i, estante=estante):
-                    inserts.append(Nivel(numero=i, estante=estante))
-
-        Nivel.objects.bulk_create(inserts)
-
-    def _genera_estructura_estantes(self, pEstante):
-        inserts = []
-        estantes = Estante.objects.filter(bodega=self.object.id)
-
-        for codigo in self._codigo_estante(pEstante):
-            if not estantes.filter(codigo=codigo):
-                inserts.append(Estante(codigo=codigo, bodega=self.object))
-
-        Estante.objects.bulk_create(inserts)
-
-    def _codigo_estante(self, numero=0):
-        codigos = []
-        for i in range(numero):
-            c1 = i // 26
-            c2 = i - c1*26
-            codigos.append('{}{}'.format('' if i<26 else ascii_uppercase[c1-1],ascii_uppercase[c2]))
-            i+=1
-        return codigos
-
 class Bodega_CreateView(CreateView_Login):
     permission_required = 'documentos.add_bodega'
     model = Bodega
-    form_class = Bodega_From
+    form_class = BodegaNueva_Form
     template_name = 'documentos/form.html'
     extra_context = {
         'title': _('Nueva Bodega'),
@@ -209,7 +143,20 @@ class Bodega_CreateView(CreateView_Login):
         context['list_url'] = Bodega.list_url()
         return context
 
-class Bodega_UpdateView(UpdateView_Login):
+    def get_form(self, *args, **kwargs):
+        form = super().get_form(*args, **kwargs)
+        if not self.request.user.has_perm('documentos.genera_estructura'):
+            del form.fields['estructura']
+        return form
+
+    def form_valid(self, form):
+        with transaction.atomic():
+            respuesta = super().form_valid(form)
+            if form.cleaned_data.get('estructura'):
+                clona_estructura(form.cleaned_data['estructura'], self.object, self.request.user)
+        return respuesta
+
+class Bodega_UpdateView(AccesoBodega_Mixin, UpdateView_Login):
     permission_required = 'documentos.change_bodega'
     model = Bodega
     form_class = Bodega_From
@@ -227,16 +174,7 @@ class Bodega_UpdateView(UpdateView_Login):
         context['list_url'] = Bodega.list_url()
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:
-            return queryset.filter(
-                Q(personal=self.request.user)
-                |Q(encargado=self.request.user)).distinct()
-
-class Bodega_DeleteView(DeleteView_Login):
+class Bodega_DeleteView(AccesoBodega_Mixin, DeleteView_Login):
     permission_required = 'documentos.delete_bodega'
     model = Bodega
     template_name = 'documentos/confirmation_form.html'
@@ -255,22 +193,65 @@ class Bodega_DeleteView(DeleteView_Login):
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:
-            return queryset.filter(
-                Q(personal=self.request.user)
-                |Q(encargado=self.request.user)).distinct()
-
     def get_success_url(self, *args, **kwargs):
         return super().get_success_url(self.object.vigente)
 
 
-class Estante_DetailView(DetailView_Login):
+def imprime_etiquetas(request, queryset, template_name, context, nombre, formato=None):
+    '''
+        Respuesta de las vistas de etiquetas de cajas o tomos. Con
+        "pendientes" se limita a lo que no se ha impreso y con "formato"
+        (pdf, svg, zpl) se genera en el servidor. Se registra como impreso lo
+        descargado con "formato" o, en la vista HTML, al confirmar con el
+        botón "Marcar como impreso" (POST); ver el registro no lo marca. Las
+        cajas se limitan a las bodegas del usuario.
+    '''
+    es_caja = queryset.model is Caja
+    impresion = ImpresionCaja if es_caja else ImpresionTomo
+    if es_caja and not request.user.is_superuser:
+        queryset = queryset.filter(bodega__in=bodegas_usuario(request.user))
+    formato = formato or request.GET.get('formato')
+    if 'pendientes' in request.GET:
+        queryset = pendientes(queryset, impresion)
+
+    if request.method == 'POST':
+        registra_impresion(queryset, impresion, request.user)
+        return redirect(request.get_full_path())
+    if formato:
+        etiquetas = etiquetas_caja(queryset) if es_caja else etiquetas_tomo(queryset)
+        respuesta = respuesta_etiquetas(etiquetas, formato, nombre)
+        registra_impresion(queryset, impresion, request.user)
+        return respuesta
+    arreglo = {registro: 'mostrar' for registro in queryset}
+    return render(request, template_name, {'arreglo': arreglo, 'context': context, 
+        'marcar': _('Marcar como impreso')})
+
+class Etiqueta_Mixin:
+    ''' El botón "Marcar como impreso" envía por POST la misma consulta de la vista '''
+    def post(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+
+class Bodega_Etiqueta(AccesoBodega_Mixin, DetailView_Login):
+    '''
+        Todas las etiquetas de cajas de la bodega, únicamente generadas en el
+        servidor (pdf por defecto o svg)
+    '''
+    permission_required = 'documentos.label_bodega'
+    model = Bodega
+
+    def get(self, request, *args, **kwargs):
+        bodega = self.get_object()
+        cajas = Caja.objects.filter(bodega=bodega)
+        return imprime_etiquetas(request, cajas, None, {'object': bodega}, 
+            f'etiquetas_{bodega.codigo}', request.GET.get('formato', 'pdf'))
+
+
+class Estante_DetailView(AccesoBodega_Mixin, DetailView_Login):
     permission_required = 'documentos.view_estante'
     model = Estante
+    queryset = Estante.objects.select_related('bodega')
+    campo_bodega = 'bodega_id'
     extra_context = {
         'title': _('Estante'),
         'sub_titulo': {
@@ -279,53 +260,41 @@ class Estante_DetailView(DetailView_Login):
         'opciones':{
             'etiqueta':_('Opciones'),
             'etiquetas':_('Etiquetas'),
+            'pendientes':_('Pendientes'),
         },
     }
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
         
-        queryset = Posicion.objects.filter(nivel__estante=self.object)\
-            .order_by('nivel__numero', 'numero')\
-            .prefetch_related('nivel', 'nivel__estante', 'nivel__estante__bodega')
-
         context['estructura']={
             'tooltip_head': _('Nivel'),
             'tooltip_body': _('Posición'),
-            'estructura': queryset,
-            'max_columnas': queryset.aggregate(Max('numero'))['numero__max'],
+            'grilla': partial(grilla_estante, self.object), # se consulta únicamente si no está en caché
+            'version': version_estructura(self.object.bodega_id),
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:    
-            return queryset.filter(
-                Q(bodega__personal=self.request.user)
-                |Q(bodega__encargado=self.request.user)).distinct()
-
-class Estante_Etiqueta(DetailView_Login):
+class Estante_Etiqueta(AccesoBodega_Mixin, Etiqueta_Mixin, DetailView_Login):
     permission_required = 'documentos.label_estante'
     template_name = 'documentos/etiqueta.html'
-    model = Caja
+    model = Estante
+    campo_bodega = 'bodega_id'
 
     def get(self, request, *args, **kwargs):
         context = {
             'title': _('Etiqueta'),
-            'object': Estante.objects.get(pk=kwargs['pk'])
+            'object': self.get_object()
         }
-        arreglo = {}
-        cajas = list(Caja.objects.filter(posicion__nivel__estante__id=self.kwargs['pk']))
-        for caja in cajas:
-            arreglo[caja] = 'mostrar'
-        return render(request, self.template_name, {'arreglo': arreglo, 'context': context})
+        cajas = Caja.objects.filter(posicion__nivel__estante=context['object'])
+        return imprime_etiquetas(request, cajas, self.template_name, context, 
+            f"etiquetas_{context['object']}")
 
 
-class Nivel_DetailView(DetailView_Login):
+class Nivel_DetailView(AccesoBodega_Mixin, DetailView_Login):
     permission_required = 'documentos.view_nivel'
     model = Nivel
+    campo_bodega = 'estante__bodega_id'
     extra_context = {
         'title': _('Nivel'),
         'sub_titulo': {
@@ -349,39 +318,30 @@ class Nivel_DetailView(DetailView_Login):
             'tooltip_head': _('Posición'),
             'tooltip_body': _('Caja'),
             'estructura': queryset,
-            'max_columnas': queryset.aggregate(Max('numero'))['numero__max'],
+            **queryset.aggregate(max_columnas=Max('numero'), max_ocupacion=Max('ocupacion')),
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:    
-            return queryset.filter(
-                Q(estante__bodega__personal=self.request.user)
-                |Q(estante__bodega__encargado=self.request.user)).distinct()
-
-class Nivel_Etiqueta(DetailView_Login):
+class Nivel_Etiqueta(AccesoBodega_Mixin, Etiqueta_Mixin, DetailView_Login):
     permission_required = 'documentos.label_nivel'
     template_name = 'documentos/etiqueta.html'
-    model = Caja
+    model = Nivel
+    campo_bodega = 'estante__bodega_id'
     
     def get(self, request, *args, **kwargs):
         context = {
             'title': _('Etiqueta'),
-            'object': Nivel.objects.get(pk=kwargs['pk'])
+            'object': self.get_object()
         }
-        arreglo = {}
-        cajas = list(Caja.objects.filter(posicion__nivel__id=self.kwargs['pk']))
-        for caja in cajas:
-            arreglo[caja] = 'mostrar'
-        return render(request, self.template_name, {'arreglo': arreglo, 'context': context})
+        cajas = Caja.objects.filter(posicion__nivel=context['object'])
+        return imprime_etiquetas(request, cajas, self.template_name, context, 
+            f"etiquetas_{context['object']}")
 
 
-class Posicion_DetailView(DetailView_Login):
+class Posicion_DetailView(AccesoBodega_Mixin, DetailView_Login):
     permission_required = 'documentos.view_posicion'
     model = Posicion
+    campo_bodega = 'nivel__estante__bodega_id'
     extra_context = {
         'title': _('Posición'),
         'sub_titulo': {
@@ -406,38 +366,30 @@ class Posicion_DetailView(DetailView_Login):
             'tooltip_head': _('Caja'),
             'tooltip_body': _('Tomo'),
             'estructura': queryset,
+            'max_ocupacion': queryset.aggregate(Max('ocupacion'))['ocupacion__max'],
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:
-            return queryset.filter(
-                Q(nivel__estante__bodega__personal=self.request.user)
-                | Q(nivel__estante__bodega__encargado=self.request.user)).distinct()
-
-class Posicion_Etiqueta(DetailView_Login):
+class Posicion_Etiqueta(AccesoBodega_Mixin, Etiqueta_Mixin, DetailView_Login):
     permission_required = 'documentos.label_posicion'
     template_name = 'documentos/etiqueta.html'
-    model = Caja
+    model = Posicion
+    campo_bodega = 'nivel__estante__bodega_id'
     
     def get(self, request, *args, **kwargs):
         context = {
             'title': _('Etiqueta'),
-            'object': Posicion.objects.get(pk=kwargs['pk'])
+            'object': self.get_object()
         }
-        arreglo = {}
-        cajas = list(Caja.objects.filter(posicion__id=self.kwargs['pk']))
-        for caja in cajas:
-            arreglo[caja] = 'mostrar'
-        return render(request, self.template_name, {'arreglo': arreglo, 'context': context})
+        cajas = Caja.objects.filter(posicion=context['object'])
+        return imprime_etiquetas(request, cajas, self.template_name, context, 
+            f"etiquetas_{context['object']}")
 
 
-class Caja_ListView(ListView_Login):
+class Caja_ListView(AccesoBodega_Mixin, ListView_Login):
     permission_required = 'documentos.view_caja'
     model = Caja
+    campo_bodega = 'bodega_id'
     paginate_by = 15
     ordering = ['posicion__nivel__estante__codigo', 'posicion__nivel__numero', 'posicion__numero', 'numero']
     extra_context = {
@@ -453,17 +405,12 @@ class Caja_ListView(ListView_Login):
     }
 
     def get_queryset(self):
-        queryset = super().get_queryset().filter(vigente=False)
-        if self.request.user.is_superuser:
-            return queryset
-        else:
-            return queryset.filter(
-                Q(posicion__nivel__estante__bodega__personal=self.request.user)
-                |Q(posicion__nivel__estante__bodega__encargado=self.request.user)).distinct()
+        return super().get_queryset().filter(vigente=False)
 
-class Caja_DetailView(DetailView_Login):
+class Caja_DetailView(AccesoBodega_Mixin, DetailView_Login):
     permission_required = 'documentos.view_caja'
     model = Caja
+    campo_bodega = 'bodega_id'
     extra_context = {
         'title': _('Caja'),
         'sub_titulo': {
@@ -477,27 +424,16 @@ class Caja_DetailView(DetailView_Login):
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
-        queryset = Tomo.objects.filter(caja=self.object)\
-            .order_by('-fecha_modificacion')\
-            .prefetch_related('credito')
         context['estructura']={
             'tooltip_head': _('Tomo'),
-            'estructura': queryset,
+            'estructura': self.object.get_tomos(),
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:
-            return queryset.filter(
-                Q(posicion__nivel__estante__bodega__personal=self.request.user)
-                |Q(posicion__nivel__estante__bodega__encargado=self.request.user)).distinct()
-
-class Caja_DeleteView(DeleteView_Login):
+class Caja_DeleteView(AccesoBodega_Mixin, DeleteView_Login):
     permission_required = 'documentos.delete_caja'
     model = Caja
+    campo_bodega = 'bodega_id'
     template_name = 'documentos/confirmation_form.html'
     extra_context = {
         'title': _('Cambiar Estado de Caja'),
@@ -514,49 +450,41 @@ class Caja_DeleteView(DeleteView_Login):
         }
         return context
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.user.is_superuser:
-            return queryset
-        else:
-            return queryset.filter(
-                Q(posicion__nivel__estante__bodega__personal=self.request.user)
-                |Q(posicion__nivel__estante__bodega__encargado=self.request.user)).distinct()
-
     def get_success_url(self, *args, **kwargs):
         return self.object.view_url()
 
-class Caja_Etiqueta(DetailView_Login):
+class Caja_Etiqueta(AccesoBodega_Mixin, Etiqueta_Mixin, DetailView_Login):
     permission_required = 'documentos.label_caja'
     template_name = 'documentos/etiqueta.html'
     model = Caja
+    campo_bodega = 'bodega_id'
     
     def get(self, request, *args, **kwargs):
-        caja = Caja.objects.get(id=self.kwargs['pk'])
+        caja = self.get_object()
         context = {
             'title': _('Etiqueta'),
             'object': caja
         }
-        arreglo = {}
-        arreglo[caja] = 'mostrar'
-        return render(request, self.template_name, {'arreglo': arreglo, 'context': context})
+        return imprime_etiquetas(request, Caja.objects.filter(id=caja.id), self.template_name, 
+            context, f'etiquetas_{caja}')
 
 
 class CargaMasiva_Form(FormView_Login):
     permission_required = 'documentos.load_credito'
     form_class = CargaCreditos_Form
     template_name = 'documentos/form_loadfile.html'
-    success_message = _('Se cargaron los registros exitosamente')
+    success_message = _('Carga registrada, se procesará en segundo plano')
     extra_context = {
         'title': _('Carga de Créditos'),
         'botones': {
             'guardar': _('Cargar'),
             'cancelar': _('Cancelar'),
-        }
+        },
+        'list_url': reverse_lazy('documentos:carga_list'),
     }
 
     def get_success_url(self):
-        return reverse_lazy('documentos:index')
+        return self.carga.view_url()
 
     def post(self, request, *args, **kwargs):
         if 'Cargar' in request.POST:
@@ -567,11 +495,59 @@ class CargaMasiva_Form(FormView_Login):
                 return self.form_invalid(form)
 
     def form_valid(self, form):
-        archivo = form.cleaned_data['archivo']
-        libro = openpyxl.load_workbook(archivo)
-        _insert_datos(datos_excel(libro[libro.sheetnames[0]]))
+        archivos = form.cleaned_data['archivos']
+        archivo = archivos[0] if len(archivos)==1 else empaqueta(archivos)
+        self.carga = CargaCredito.objects.create(archivo=archivo, 
+            actualizar=form.cleaned_data['actualizar'], crear_tomo=form.cleaned_data['crear_tomo'],
+            usuario=self.request.user)
         return super().form_valid(form)
 
+class CargaCredito_ListView(ListView_Login):
+    permission_required = 'documentos.load_credito'
+    model = CargaCredito
+    paginate_by = 15
+    ordering = ['-fecha_creacion']
+    extra_context = {
+        'title': _('Cargas de Créditos'),
+        'opciones': {
+            'etiqueta': _('Opciones'),
+            'ver': _('Ver'),
+            'nuevo': _('Nuevo'),
+        },
+        'mensaje_vacio': _('No hay cargas registradas'),
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset().select_related('usuario')
+        if self.request.user.is_superuser:
+            return queryset
+        else:
+            return queryset.filter(usuario=self.request.user)
+
+class CargaCredito_DetailView(DetailView_Login):
+    permission_required = 'documentos.load_credito'
+    model = CargaCredito
+    extra_context = {
+        'title': _('Carga de Créditos'),
+        'etiquetas': {
+            'reporte': _('Errores'),
+            'fila': _('Fila'),
+            'mensaje': _('Error'),
+        },
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.user.is_superuser:
+            return queryset
+        else:
+            return queryset.filter(usuario=self.request.user)
+
+class CargaCredito_Estado(CargaCredito_DetailView):
+    ''' Avance de la carga en formato JSON, se consulta desde el detalle '''
+    def render_to_response(self, context, **response_kwargs):
+        return JsonResponse(self.object.progreso())
+
 class Credito_DetailView(DetailView_Login):
     permission_required = 'documentos.view_credito'
     model = Credito
@@ -586,6 +562,7 @@ class Credito_DetailView(DetailView_Login):
         'opciones':{
             'etiqueta':_('Opciones'),
             'etiquetas':_('Etiquetas'),
+            'pendientes':_('Pendientes'),
             'escaneado': _('Escaneado'),
             'agregar_tomo':_('Agregar tomo'),
             'remover_tomo':_('Remover tomo'),
@@ -597,14 +574,12 @@ class Credito_DetailView(DetailView_Login):
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
         context['egreso_form']=EgresoTomo_Form()
-        context['tomos'] = Tomo.objects.filter(credito=self.object, vigente=True)\
-            .order_by('numero').prefetch_related('caja', 'caja__posicion', 
-                'caja__posicion__nivel', 'caja__posicion__nivel__estante', 
-                'caja__posicion__nivel__estante__bodega',
-                'caja__posicion__nivel__estante__bodega__personal')
+        context['tomos'] = asigna_posiciones(list(Tomo.objects.filter(credito=self.object, vigente=True)\
+            .order_by('numero').select_related('caja', 'bodega')))
+        context['bodegas_personal'] = bodegas_personal(self.request.user)
         return context
 
-class Credito_Etiqueta(DetailView_Login):
+class Credito_Etiqueta(Etiqueta_Mixin, DetailView_Login):
     permission_required = 'documentos.label_credito'
     template_name = 'documentos/etiqueta_tomo.html'
     model = Tomo
@@ -614,11 +589,9 @@ class Credito_Etiqueta(DetailView_Login):
             'title': _('Etiqueta'),
             'object': Credito.objects.get(pk=kwargs['pk'])
         }
-        arreglo = {}
-        tomos = list(Tomo.objects.filter(credito__id=self.kwargs['pk'], vigente=True).order_by('numero'))
-        for tomo in tomos:
-            arreglo[tomo] = 'mostrar'
-        return render(request, self.template_name, {'arreglo': arreglo, 'context': context})
+        tomos = Tomo.objects.filter(credito__id=self.kwargs['pk'], vigente=True).order_by('numero')
+        return imprime_etiquetas(request, tomos, self.template_name, context, 
+            f"etiquetas_{context['object'].numero}")
 
 
 class Tomo_Ingreso(FormView_Login):
@@ -629,6 +602,7 @@ class Tomo_Ingreso(FormView_Login):
         'title': _('Ingreso a Bodega'),
         'botones': {
             'guardar': _('Guardar'),
+            'sugerir': _('Sugerir caja'),
             'cancelar': _('Cancelar'),
         },
         'list_url': reverse_lazy('documentos:index'),
@@ -643,6 +617,25 @@ class Tomo_Ingreso(FormView_Login):
                 return self.form_valid(form)
             else: 
                 return self.form_invalid(form)
+        elif 'Sugerir' in request.POST:
+            return self.sugerir(self.get_form())
+
+    def sugerir(self, form):
+        ''' Completa la caja del formulario con la sugerida para el tomo '''
+        form.is_valid()
+        tomo = form.cleaned_data.get('tomo')
+        tomo_qs = Tomo.objects.filter(credito__numero=tomo[0], numero=tomo[1]).first() if tomo else None
+        caja = sugiere_caja(tomo_qs, bodegas_personal(self.request.user)) if tomo_qs else None
+        if tomo_qs is None:
+            messages.warning(self.request, _('Tomo no encontrado'))
+        elif caja is None:
+            messages.warning(self.request, _('No hay cajas con espacio disponible'))
+        else:
+            datos = form.data.copy()
+            datos['caja'] = caja.codigo
+            form = self.get_form_class()(datos)
+            messages.info(self.request, _('Caja sugerida: ')+f'{caja} ({caja.ocupacion}/{caja.capacidad})')
+        return self.render_to_response(self.get_context_data(form=form))
     
     def form_valid(self, form, *args, **kwargs):
         tomo = form.cleaned_data['tomo']
@@ -651,21 +644,27 @@ class Tomo_Ingreso(FormView_Login):
 
         try:
             tomo_qs = Tomo.objects.get(credito__numero=tomo[0], numero=tomo[1])
-            caja_qs = Caja.objects.get(posicion__nivel__estante__bodega__codigo=caja[0].upper(), 
-                posicion__nivel__estante__codigo=caja[1].upper(), posicion__nivel__numero=caja[2], 
-                posicion__numero=caja[3], numero=caja[4])
+            caja_qs = Caja.objects.select_related('bodega').get(codigo=caja)
+            bodega = caja_qs.bodega
             
-            if not self.request.user in caja_qs.posicion.nivel.estante.bodega.personal.all():
+            if bodega.id not in bodegas_personal(self.request.user):
                 messages.warning(self.request, _('Usuario no puede asignar expedientes en esa caja'))
             elif not caja_qs.vigente:
                 messages.warning(self.request, _('La caja no se encuentra habilitada'))
-            elif not caja_qs.posicion.nivel.estante.bodega.vigente:
+            elif not bodega.vigente:
                 messages.warning(self.request, _('La bodega no se encuentra habilitada'))
+            elif not tomo_qs.caja and caja_qs.ocupacion >= caja_qs.capacidad:
+                messages.warning(self.request, _('La caja se encuentra llena'))
             elif not tomo_qs.caja:
+                habilita = not tomo_qs.vigente
                 tomo_qs.comentario, tomo_qs.vigente = comentario, True
                 tomo_qs.caja, tomo_qs.usuario = caja_qs, self.request.user
                 tomo_qs._change_reason, tomo_qs._history_user = 'Tomo_Ingreso', self.request.user
-                tomo_qs.save()
+                with transaction.atomic():
+                    tomo_qs.save()
+                    ajusta_ocupacion({caja_qs.id: 1})
+                    if habilita:
+                        tomo_qs.credito.suma_tomos(1)
                 messages.success(self.request, _('Se guardo el tomo ')+f'{tomo[0]}-{tomo[1]}')
 
                 return redirect(tomo_qs.credito.view_url())
@@ -675,7 +674,7 @@ class Tomo_Ingreso(FormView_Login):
             messages.warning(self.request, _('Tomo o caja no encontrado ')+f'{tomo[0]}-{tomo[1]}')
         return super().form_valid(form)
 
-class Tomo_Etiqueta(DetailView_Login):
+class Tomo_Etiqueta(Etiqueta_Mixin, DetailView_Login):
     permission_required = 'documentos.label_tomo'
     template_name = 'documentos/etiqueta_tomo.html'
     model = Tomo
@@ -685,11 +684,9 @@ class Tomo_Etiqueta(DetailView_Login):
             'title': _('Etiqueta'),
             'object': Credito.objects.get(tomo_credito__pk=self.kwargs['pk'])
         }
-        arreglo = {}    
-        tomos = list(Tomo.objects.filter(id=self.kwargs['pk']))
-        for tomo in tomos:
-            arreglo[tomo] = 'mostrar'
-        return render(request, self.template_name, {'arreglo': arreglo, 'context': context})
+        tomos = Tomo.objects.filter(id=self.kwargs['pk'])
+        return imprime_etiquetas(request, tomos, self.template_name, context, 
+            f"etiquetas_{context['object'].numero}")
 
 class Tomo_Template(TemplateView_Login):
     permission_required = 'documentos.change_tomo'
@@ -701,8 +698,12 @@ class Tomo_Template(TemplateView_Login):
             'eliminar': _('Eliminar'),
             'trasladar': _('Trasladar'),
             'egresar': _('Egresar'),
+            'agregar': _('Agregar'),
+            'quitar': _('Quitar seleccionados'),
+            'vaciar': _('Vaciar lista'),
         },
         'sub_titulo': {
+            'agregar':_('Agregar tomos'),
             'traslado':_('Traslado de bodega'),
             'egreso': _('Egreso de bodega'),
         },
@@ -711,10 +712,8 @@ class Tomo_Template(TemplateView_Login):
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
-        tomos = self.request.session.get('extraer_tomos', [])
-        tomo_qs = Tomo.objects.filter(id__in=tomos)\
-            .order_by('credito__numero', 'numero')
-        context['object_list'] = tomo_qs
+        context['object_list'] = tomos_envio(self.request.user)
+        context['envio_form'] = EnvioTomos_Form()
         context['traslado_form'] = TrasladoTomos_Form()
         context['egreso_form'] = SalidaTomos_Form()
         return context
@@ -722,6 +721,13 @@ class Tomo_Template(TemplateView_Login):
 
 def buscar_credito(request):
     numero = request.GET['numero'].replace(' ','').split('-')
+    if len(numero)==5 and all(valor.isdigit() for valor in numero[2:]):
+        caja = Caja.objects.filter(codigo=codigo_caja(*numero)).first()
+        if caja:
+            return redirect(caja.view_url())
+        messages.warning(request, _('No se encontró la caja: ')+codigo_caja(*numero))
+        return redirect(reverse_lazy('documentos:index'))
+
     credito = Credito.objects.filter(numero=numero[0])
     if credito:
         return redirect(credito[0].view_url())
@@ -737,7 +743,7 @@ def operaciones_tomo(request, pk=None):
         credito.escaneado = True
         credito._history_user = request.user
         credito._change_reason = 'operaciones_tomo > escaneado '
-        credito.save()
+        credito.save(update_fields=['escaneado'])
     elif 'agregar.x' in request.POST:
         ''' Crea/Habilita un tomo '''
         credito = Credito.objects.get(id=request.POST['credito'])
@@ -748,21 +754,27 @@ def operaciones_tomo(request, pk=None):
                 usuario=request.user)
             tomo._change_reason = 'operaciones_tomo > agregar (unico nuevo)'
             tomo._history_user = request.user
-            tomo.save()
+            with transaction.atomic():
+                tomo.save()
+                credito.suma_tomos(1)
         elif tomos.filter(vigente=False):
             #tomo minimo inhabilitado
             tomo = tomos.filter(vigente=False).order_by('numero')[0]
             tomo.usuario, tomo.vigente = request.user, True
             tomo.comentario = 'Tomo habilitado'
             tomo._change_reason, tomo._history_user = 'operaciones_tomo > agregar (habilita existente)', request.user
-            tomo.save()
+            with transaction.atomic():
+                tomo.save()
+                credito.suma_tomos(1)
         else:
             num = tomos.aggregate(Max('numero'))['numero__max']+1
             tomo = Tomo(numero=num, credito=credito, comentario='Tomo habilitado', 
                 usuario=request.user)
             tomo._change_reason = 'operaciones_tomo > agregar (agrega nuevo)'
             tomo._history_user = request.user
-            tomo.save()
+            with transaction.atomic():
+                tomo.save()
+                credito.suma_tomos(1)
     elif 'remover.x' in request.POST:
         ''' Ihabilita un tomo '''
         credito = Credito.objects.get(id=request.POST['credito'])
@@ -779,10 +791,11 @@ def operaciones_tomo(request, pk=None):
                 tomo.usuario, tomo.vigente = request.user, False
                 tomo.comentario='Tomo inhabilitado'
                 tomo._change_reason, tomo._history_user = 'operaciones_tomo > remover', request.user
-                tomo.save()
+                with transaction.atomic():
+                    tomo.save()
+                    credito.suma_tomos(-1)
     elif 'agregar' in request.POST:
         ''' Agrega tomos a a lista que se extraera de la bodega '''
-        extraer_tomos=request.session['extraer_tomos'] if 'extraer_tomos' in request.session else []
         tomoid = request.POST['tomo-id']
         tomo = request.POST['tomo'].replace(' ', '').split('-')
 
@@ -790,9 +803,7 @@ def operaciones_tomo(request, pk=None):
             if len(tomo)==2:
                 t = Tomo.objects.get(credito__numero=tomo[0], numero=int(tomo[1]))
                 if t and str(t.id)==tomoid:
-                    if not tomoid in extraer_tomos:
-                        extraer_tomos.append(tomoid)
-                        request.session['extraer_tomos']=extraer_tomos
+                    if EnvioTomo.objects.get_or_create(usuario=request.user, tomo=t)[1]:
                         messages.success(request, _('Tomo agregado a la lista'))
                     else:
                         messages.warning(request, _('Tomo agregado previamente'))
@@ -806,189 +817,75 @@ def operaciones_tomo(request, pk=None):
             return redirect(Tomo.objects.get(id=tomoid).credito.view_url())   
     else: #'quitar' in request.POST:
         ''' Elimina tomos del listado a trasladar/egresar '''
-        try: 
-            extraer_tomos = request.session['extraer_tomos']
-            extraer_tomos.remove(str(pk))
-            request.session['extraer_tomos'] = extraer_tomos
-        finally:
-            return redirect(Tomo.envio_url())
+        quita_envio(request.user, [pk])
+        return redirect(Tomo.envio_url())
     return redirect(credito.view_url())
+
+@permission_required('documentos.change_tomo', login_url=reverse_lazy('login'))
+def lista_envio(request):
+    ''' Agrega varios tomos a la lista de envío o quita los seleccionados (o todos) '''
+    if 'agregar' in request.POST:
+        form = EnvioTomos_Form(request.POST)
+        if form.is_valid():
+            pares, invalidos = form.cleaned_data['tomos']
+            agregados, no_disponibles = agrega_envio(request.user, pares)
+            messages.success(request, _('Tomos agregados a la lista: ')+str(agregados))
+            if invalidos:
+                messages.warning(request, _('Formato incorrecto: ')+', '.join(invalidos))
+            if no_disponibles:
+                messages.warning(request, _('No encontrados o fuera de sus bodegas: ')
+                    +', '.join(f'{credito}-{numero}' for credito, numero in no_disponibles))
+        else:
+            messages.warning(request, _('No se ingresó ningún tomo válido'))
+    elif 'quitar' in request.POST:
+        quita_envio(request.user, request.POST.getlist('tomos'))
+    elif 'vaciar' in request.POST:
+        quita_envio(request.user)
+    return redirect(Tomo.envio_url())
     
 def salida_tomo(request):
+    '''
+        Los correos se registran en la bandeja de salida dentro de la misma
+        transacción de la salida y los envía el comando "envia_correos"
+    '''
     if 'trasladar' in request.POST:
         try:
             form = TrasladoTomos_Form(request.POST)
             if form.is_valid():
                 bodega = form.cleaned_data['bodega_envio']
-                comentario = f'Traslado a {bodega}\n{form.cleaned_data["comentario"]}'
-                tomos = Tomo.objects.filter(id__in=request.session['extraer_tomos'])
-                tomos.update(comentario=comentario, caja=None, usuario=request.user)
-                for tomo in tomos : tomo._change_reason, tomo._history_user = 'salida_tomo > trasladar', request.user
-                bulk_update_with_history(tomos, Tomo, ['comentario', 'caja'], batch_size=1500)
-                del request.session['extraer_tomos']
+                with transaction.atomic():
+                    movimientos, tomos = salida_envio(request.user, {'tipo': Movimiento.TRASLADO, 
+                        'bodega_destino': bodega, 'comentario': form.cleaned_data['comentario']}, 
+                        'salida_tomo > trasladar')
+                    if tomos and bodega.correo_traslado and not bodega.correo_resumen:
+                        context = {
+                            'title': _('Traslado'),
+                            'message': _(f'Se han enviado, a {bodega}, los siguientes tomos:'),
+                            'object_list': tomos,
+                        }
+                        encola_correo('Traslado de Expedientes', request.user.email, [bodega.encargado.email], 'mails/egresos.html', context)
                 messages.success(request, _('Tomos egresados por traslado'))
-                
-                context = {
-                    'title': _('Traslado'),
-                    'message': _(f'Se han enviado, a {bodega}, los siguientes tomos:'),
-                    'object_list': {tomo for tomo in tomos},
-                }
-                correo = crea_correo('Traslado de Expedientes', request.user.email, [bodega.encargado.email], 'mails/egresos.html', context)
-                envia_correo(correo)
         finally:
             return redirect(Tomo.envio_url())
     elif 'egresar' in request.POST:
         try:
             form = SalidaTomos_Form(request.POST)
             if form.is_valid():
-                correo_form = form.cleaned_data["correo"]
-                print(f"correo>>>{correo_form}")
-                comentario_final = f'Fecha: \t\t{datetime.today().strftime("%d-%m-%Y")}\n'
-                comentario_final += f'Codigo: \t{form.cleaned_data["codigo"]}\n'
-                comentario_final += f'Nombre: \t{form.cleaned_data["nombre"]}\n'
-                comentario_final += f'Extension: \t{form.cleaned_data["extension"]}\n'
-                comentario_final += f'Correo: \t{correo_form}\n'
-                comentario_final += f'Gerencia: \t{form.cleaned_data["gerencia"]}\n'
-                comentario_final += f'Comentario: \t{form.cleaned_data["comentario"]}'
-
-                tomos = Tomo.objects.filter(id__in=request.session['extraer_tomos'])
-                tomos.update(comentario=comentario_final, caja=None, usuario=request.user)
-                for tomo in tomos : tomo._change_reason, tomo._history_user = 'salida_tomo > egresar', request.user
-                bulk_update_with_history(tomos, Tomo, ['comentario', 'caja'], batch_size=1500)
-                del request.session['extraer_tomos']
+                datos = {campo: form.cleaned_data[campo] 
+                    for campo in ('codigo', 'nombre', 'extension', 'correo', 'gerencia', 'comentario')}
+                with transaction.atomic():
+                    movimientos, tomos = salida_envio(request.user, dict(datos, tipo=Movimiento.EGRESO), 
+                        'salida_tomo > egresar')
+                    avisos = [tomo for tomo in tomos 
+                        if tomo.movimiento.bodega_origen is None or tomo.movimiento.bodega_origen.correo_egreso]
+                    if avisos:
+                        context = {
+                            'title': _('Egreso por Solicitud'),
+                            'message': _(f'Se han entregado, los siguientes tomos:'),
+                            'object_list': avisos,
+                            'comentario': movimientos[0].detalle(),
+                        }
+                        encola_correo('Egreso por solicitud', request.user.email, [request.user.email, datos['correo']], 'mails/egresos.html', context)
                 messages.success(request, _('Tomos egresados por solicitud'))
-                
-                context = {
-                    'title': _('Egreso por Solicitud'),
-                    'message': _(f'Se han entregado, los siguientes tomos:'),
-                    'object_list': {tomo for tomo in tomos},
-                    'comentario': comentario_final,
-                }
-                correo = crea_correo('Egreso por solicitud', request.user.email, [request.user.email,correo_form], 'mails/egresos.html', context)
-                envia_correo(correo)
         finally:
             return redirect(Tomo.envio_url())
-
-
-
-##########################################################################
-#
-##########################################################################
-def crea_correo(subject, from_email, to_email, template, context):
-    template = get_template(template)
-    content = template.render(context)
-
-    mail = EmailMultiAlternatives(
-        subject=subject,
-        body='',
-        from_email=from_email,
-        to=to_email,
-        cc=[],
-        )
-
-    mail.attach_alternative(content, 'text/html')
-    return mail
-
-def envia_correo(mail):
-    ''' Envío asincrono de correos '''
-    thread = threading.Thread(
-        mail.send(fail_silently=False)
-    )
-    thread.start()
-    
-##########################################################################
-#
-##########################################################################
-def datos_excel(hoja):    
-    orden = {}
-    for i in range(len(hoja[1])):
-        orden[hoja[1][i].value]=i
-
-    clientes = []
-    oficinas = []
-    monedas = []
-    productos = []
-    creditos = []
-    for fila in hoja.iter_rows(min_row=2):
-        mis     = fila[orden['Cod_Cliente']].value
-        cliente = fila[orden['Cliente']].value
-        if not any(mis in sublist for sublist in clientes):
-            clientes.append([mis, cliente])
-
-        cod_ofi = fila[orden['Cod_ofi']].value
-        oficina = fila[orden['Oficina']].value 
-        if not any(cod_ofi in sublist for sublist in oficinas):
-            oficinas.append([cod_ofi, oficina])
-
-        moneda  = fila[orden['Moneda']].value
-        if not moneda in monedas:
-            monedas.append(moneda)
-
-        producto = fila[orden['Producto']].value
-        if not producto in productos:
-            productos.append(producto)
-
-        credito = fila[orden['Credito']].value
-        fecha   = datetime.strptime(fila[orden['Fecha_Ini']].value, "%d/%m/%Y").strftime("%Y-%m-%d")
-        monto   = fila[orden['Monto']].value
-        if not any(credito in sublist for sublist in creditos):
-            creditos.append([credito, fecha, monto, mis, cod_ofi, moneda, producto])
-        
-    return {'clientes': clientes, 'oficinas': oficinas, 'monedas': monedas, 
-        'productos': productos,'creditos': creditos}
-
-def _insert_datos(datos):
-    clientes = _insert_clientes(datos['clientes'])
-    oficinas = _insert_oficinas(datos['oficinas'])
-    monedas = _insert_monedas(datos['monedas'])
-    productos = _insert_productos(datos['productos'])
-    creditos = _insert_creditos(datos['creditos'])
-
-def _insert_clientes(datos):
-    clientes = []
-    queryset = Cliente.objects.filter(codigo__in=[int(dato[0]) for dato in datos])
-    for dato in datos:
-        if not queryset.filter(codigo=int(dato[0])):
-            clientes.append(Cliente(codigo=int(dato[0]), nombre=dato[1]))
-    Cliente.objects.bulk_create(clientes)
-
-def _insert_oficinas(datos):
-    oficinas = []
-    queryset = Oficina.objects.filter(numero__in=[int(dato[0]) for dato in datos])
-    for dato in datos:
-        if not queryset.filter(numero=int(dato[0])):
-            oficinas.append(Oficina(numero=int(dato[0]), descripcion=dato[1]))
-    Oficina.objects.bulk_create(oficinas)
-
-def _insert_monedas(datos):
-    monedas = []
-    queryset = Moneda.objects.filter(descripcion__in=datos)
-    for dato in datos:
-        if not queryset.filter(descripcion=dato):
-            monedas.append(Moneda(descripcion=dato))
-    Moneda.objects.bulk_create(monedas)
-
-def _insert_productos(datos):
-    productos = []
-    queryset = Producto.objects.filter(descripcion__in=datos)
-    for dato in datos:
-        if not queryset.filter(descripcion=dato):
-            productos.append(Producto(descripcion=dato))
-    Producto.objects.bulk_create(productos)
-
-def _insert_creditos(datos):
-    queryset = Credito.objects.filter(numero__in=[dato[0] for dato in datos])
-    clientes = Cliente.objects.filter(codigo__in=[int(dato[3]) for dato in datos])
-    oficinas = Oficina.objects.filter(numero__in=[int(dato[4]) for dato in datos])
-    monedas = Moneda.objects.filter(descripcion__in=[dato[5] for dato in datos])
-    productos = Producto.objects.filter(descripcion__in=[dato[6] for dato in datos])
-
-    creditos = []
-    for dato in datos:
-        if not queryset.filter(numero=dato[0]):
-            creditos.append(Credito(numero=dato[0], fecha_concesion=dato[1], 
-                monto=dato[2], cliente=clientes.get(codigo=int(dato[3])), 
-                moneda=monedas.get(descripcion=dato[5]), 
-                oficina=oficinas.get(numero=int(dato[4])), 
-                producto=productos.get(descripcion=dato[6])))
-    bulk_create_with_history(creditos, Credito, batch_size=1500)
\ No newline at end of file
@@ -3,4 +3,9 @@ register = template.Library()
 
 @register.filter(is_safe=False)
 def modulo(value, arg):
-    return int(value) % int(arg)
\ No newline at end of file
+    return int(value) % int(arg)
+@register.filter(is_safe=False)
+def proporcion(value, arg):
+    ''' value/arg entre 0 y 1 con punto decimal (para estilos), 0 si arg es 0 '''
+    total = int(arg or 0)
+    return f'{min(int(value or 0)/total, 1):.2f}' if total else '0.00'